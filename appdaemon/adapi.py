@@ -1,5 +1,6 @@
 import asyncio
 import datetime
+import functools
 import inspect
 import iso8601
 import re
@@ -203,6 +204,8 @@ class ADAPI:
             pin (bool, optional): If True, the callback will be pinned to a particular thread.
             pin_thread (int, optional): Specify which thread from the worker pool the callback
                 will be run by (0 - number of threads -1).
+            priority (int, optional): Priority of the callback while it waits for a thread, higher
+                priorities running first. Defaults to the App's ``priority`` in apps.yaml, or ``0``.
 
         Returns:
             A unique identifier that can be used to cancel the callback if required.
@@ -472,7 +475,8 @@ class ADAPI:
             **kwargs (optional): Zero or more keyword arguments.
 
         Keyword Args:
-            writeback (str, optional): The writeback to be used. WIll be safe by default
+            writeback (str, optional): The writeback to be used, one of ``safe``, ``performance``, ``hybrid``
+                or ``batch``. WIll be safe by default
             persist (bool, optional): If to make the namespace persistent. So if AD reboots
                 it will startup will all the created entities being intact. It is persistent by default
 
@@ -1320,6 +1324,12 @@ class ADAPI:
                 state will be set to ``None``.
             oneshot (bool, optional): If ``True``, the callback will be automatically cancelled
                 after the first state change that results in a callback.
+            throttle (float, optional): Minimum number of seconds between two calls of the callback. State
+                changes that would call it sooner are ignored.
+            debounce (float, optional): Only call the callback once the state has stopped changing for this
+                many seconds, with the latest new state and the old state from before the first change.
+            max_rate (float, optional): Maximum number of calls of the callback per second, allowing short
+                bursts of up to that many calls. State changes over the rate are ignored.
             namespace (str, optional): Namespace to use for the call. See the section on
                 `namespaces <APPGUIDE.html#namespaces>`__ for a detailed description. In most cases,
                 it is safe to ignore this parameter. The value ``global`` for namespace has special
@@ -1327,6 +1337,8 @@ class ADAPI:
             pin (bool, optional): If ``True``, the callback will be pinned to a particular thread.
             pin_thread (int, optional): Sets which thread from the worker pool the callback will be
                 run by (0 - number of threads -1).
+            priority (int, optional): Priority of the callback while it waits for a thread, higher
+                priorities running first. Defaults to the App's ``priority`` in apps.yaml, or ``0``.
             *kwargs (optional): Zero or more keyword arguments that will be supplied to the callback
                 when it is called.
 
@@ -1477,10 +1489,10 @@ class ADAPI:
                 whole entity doesn't exist (Default: ``None``).
             copy (bool, optional): By default, a copy of the stored state object is returned.
                 When you set ``copy`` to ``False``, you get the same object as is stored
-                internally by AppDaemon. Avoiding the copying brings a small performance gain,
-                but also gives you write-access to the internal AppDaemon data structures,
-                which is dangerous. Only disable copying when you can guarantee not to modify
-                the returned state object, e.g., you do read-only operations.
+                internally by AppDaemon. Avoiding the copying brings a small performance gain.
+                Stored state objects are read only, and changing one raises a ``TypeError``.
+                AppDaemon never modifies a stored state object in place either, so an uncopied
+                result is a consistent snapshot that won't change underneath you as new state arrives.
             **kwargs (optional): Zero or more keyword arguments.
 
         Keyword Args:
@@ -1846,10 +1858,21 @@ class ADAPI:
 
             pin_thread (int, optional): Specify which thread from the worker pool the callback
                 will be run by (0 - number of threads -1).
+            priority (int, optional): Priority of the callback while it waits for a thread, higher
+                priorities running first. Defaults to the App's ``priority`` in apps.yaml, or ``0``.
 
             timeout (int, optional): If ``timeout`` is supplied as a parameter, the callback will be created as normal,
                  but after ``timeout`` seconds, the callback will be removed.
 
+            throttle (float, optional): Minimum number of seconds between two calls of the callback. Events
+                that would call it sooner are ignored.
+
+            debounce (float, optional): Only call the callback once no matching event has been fired for this
+                many seconds, with the latest event.
+
+            max_rate (float, optional): Maximum number of calls of the callback per second, allowing short
+                bursts of up to that many calls. Events over the rate are ignored.
+
             **kwargs (optional): One or more keyword value pairs representing App specific
                 parameters to supply to the callback. If the keywords match values within the
                 event data, they will act as filters, meaning that if they don't match the
@@ -2378,6 +2401,8 @@ class ADAPI:
             pin (bool, optional): If True, the callback will be pinned to a particular thread.
             pin_thread (int, optional): Specify which thread from the worker pool the callback
                 will be run by (0 - number of threads -1).
+            priority (int, optional): Priority of the callback while it waits for a thread, higher
+                priorities running first. Defaults to the App's ``priority`` in apps.yaml, or ``0``.
             **kwargs: Arbitrary keyword parameters to be provided to the callback
                 function when it is invoked.
 
@@ -2428,6 +2453,8 @@ class ADAPI:
             pin (bool, optional): If True, the callback will be pinned to a particular thread.
             pin_thread (int, optional): Specify which thread from the worker pool the callback
                 will be run by (0 - number of threads -1).
+            priority (int, optional): Priority of the callback while it waits for a thread, higher
+                priorities running first. Defaults to the App's ``priority`` in apps.yaml, or ``0``.
             **kwargs: Arbitrary keyword parameters to be provided to the callback
                 function when it is invoked.
 
@@ -2497,6 +2524,8 @@ class ADAPI:
             pin (bool, optional): If ``True``, the callback will be pinned to a particular thread.
             pin_thread (int, optional): Specify which thread from the worker pool the callback
                 will be run by (0 - number of threads -1).
+            priority (int, optional): Priority of the callback while it waits for a thread, higher
+                priorities running first. Defaults to the App's ``priority`` in apps.yaml, or ``0``.
             **kwargs: Arbitrary keyword parameters to be provided to the callback
                 function when it is invoked.
 
@@ -2576,6 +2605,8 @@ class ADAPI:
             pin (bool, optional): If ``True``, the callback will be pinned to a particular thread.
             pin_thread (int, optional): Specify which thread from the worker pool the callback
                 will be run by (0 - number of threads -1).
+            priority (int, optional): Priority of the callback while it waits for a thread, higher
+                priorities running first. Defaults to the App's ``priority`` in apps.yaml, or ``0``.
             **kwargs: Arbitrary keyword parameters to be provided to the callback
                 function when it is invoked.
 
@@ -2654,6 +2685,8 @@ class ADAPI:
             pin (bool, optional): If ``True``, the callback will be pinned to a particular thread.
             pin_thread (int, optional): Specify which thread from the worker pool the callback
                 will be run by (0 - number of threads -1).
+            priority (int, optional): Priority of the callback while it waits for a thread, higher
+                priorities running first. Defaults to the App's ``priority`` in apps.yaml, or ``0``.
             **kwargs: Arbitrary keyword parameters to be provided to the callback
                 function when it is invoked.
 
@@ -2704,6 +2737,8 @@ class ADAPI:
             pin (bool, optional): If True, the callback will be pinned to a particular thread.
             pin_thread (int, optional): Specify which thread from the worker pool the callback
                 will be run by (0 - number of threads -1).
+            priority (int, optional): Priority of the callback while it waits for a thread, higher
+                priorities running first. Defaults to the App's ``priority`` in apps.yaml, or ``0``.
             **kwargs: Arbitrary keyword parameters to be provided to the callback
                 function when it is invoked.
 
@@ -2754,6 +2789,8 @@ class ADAPI:
             pin (bool, optional): If ``True``, the callback will be pinned to a particular thread.
             pin_thread (int, optional): Specify which thread from the worker pool the callback
                 will be run by (0 - number of threads -1).
+            priority (int, optional): Priority of the callback while it waits for a thread, higher
+                priorities running first. Defaults to the App's ``priority`` in apps.yaml, or ``0``.
 
 
         Returns:
@@ -2837,6 +2874,8 @@ class ADAPI:
             pin (bool, optional): If ``True``, the callback will be pinned to a particular thread.
             pin_thread (int, optional): Specify which thread from the worker pool the callback
                 will be run by (0 - number of threads -1).
+            priority (int, optional): Priority of the callback while it waits for a thread, higher
+                priorities running first. Defaults to the App's ``priority`` in apps.yaml, or ``0``.
 
         Returns:
             A handle that can be used to cancel the timer.
@@ -2888,6 +2927,8 @@ class ADAPI:
             pin (bool, optional): If ``True``, the callback will be pinned to a particular thread.
             pin_thread (int, optional): Specify which thread from the worker pool the callback
                 will be run by (0 - number of threads -1).
+            priority (int, optional): Priority of the callback while it waits for a thread, higher
+                priorities running first. Defaults to the App's ``priority`` in apps.yaml, or ``0``.
 
         Returns:
             A handle that can be used to cancel the timer.
@@ -2976,9 +3017,18 @@ class ADAPI:
     # Async
     #
 
+    def _get_executor(self):
+        if self.AD.app_management.objects[self.name].get("executor") == "process":
+            return self.AD.get_process_executor()
+        return self.AD.executor
+
     async def run_in_executor(self, func, *args, **kwargs):
         """Runs a Sync function from within an Async function using Executor threads.
             The function is actually awaited during execution
+
+            If the app is configured with ``executor: process``, the function is run in a separate process
+            instead, so CPU intensive work doesn't hold up the rest of AppDaemon. It must then be a module level
+            function, and its arguments and result must be picklable.
         Args:
             func: The function to be executed.
             *args (optional): Any additional arguments to be used by the function
@@ -2988,13 +3038,21 @@ class ADAPI:
         Examples:
             >>> await self.run_in_executor(self.run_request)
         """
-        return await utils.run_in_executor(self, func, *args, **kwargs)
+        executor = self._get_executor()
+        if executor is self.AD.executor:
+            return await utils.run_in_executor(self, func, *args, **kwargs)
+        return await self.AD.loop.run_in_executor(executor, functools.partial(func, *args, **kwargs))
 
     def submit_to_executor(self, func, *args, **kwargs):
         """Submits a Sync function from within another Sync function to be executed using Executor threads.
             The function is not waited to be executed. As it submits and continues the rest of the code.
             This can be useful if wanting to execute a long running code, and don't want it to hold up the
             thread for other callbacks.
+
+            If the app is configured with ``executor: process``, the function is run in a separate process
+            instead, so CPU intensive work doesn't hold up the other apps. It must then be a module level
+            function, and its arguments and result must be picklable. It can't use the AppDaemon API, so pass it
+            any state it needs, and act on its result in the callback, which runs in the app as usual.
         Args:
             func: The function to be executed.
             *args (optional): Any additional arguments to be used by the function
@@ -3047,7 +3105,7 @@ class ADAPI:
             except Exception as e:
                 self.error(e, level="ERROR")
 
-        f = self.AD.executor.submit(func, *args, **kwargs)
+        f = self._get_executor().submit(func, *args, **kwargs)
 
         if callback is not None:
             self.logger.debug("Adding add_done_callback for future %s for %s", f, self.name)
@@ -15,6 +15,9 @@ class AdminLoop:
 
     async def loop(self):
         while not self.stopping:
+            if self.AD.threading is not None:
+                await self.AD.threading.flush_thread_info()
+
             if self.AD.http.stats_update != "none" and self.AD.sched is not None:
                 await self.AD.threading.get_callback_update()
                 await self.AD.threading.get_q_update()
@@ -137,8 +137,15 @@ class AppManagement:
             return None
 
     async def get_app_instance(self, name, id):
-        if name in self.objects and self.objects[name]["id"] == id:
-            return self.AD.app_management.objects[name]["object"]
+        return self.get_app_instance_nowait(name, id)
+
+    def get_app_instance_nowait(self, name, id):
+        #
+        # Safe to call from worker threads - a single dict lookup, so we never see a half removed entry
+        #
+        app = self.objects.get(name)
+        if app is not None and app["id"] == id:
+            return app["object"]
         else:
             return None
 
@@ -349,6 +356,9 @@ class AppManagement:
                     "id": uuid.uuid4().hex,
                     "pin_app": self.AD.threading.app_should_be_pinned(name),
                     "pin_thread": pin,
+                    "lane_app": self.AD.threading.app_should_be_lane(name),
+                    "executor": self.AD.threading.app_executor(name),
+                    "callback_priority": self.AD.threading.app_priority(name),
                     "running": True,
                 }
 
@@ -904,6 +914,7 @@ class AppManagement:
 
             found_files = []
             modules = []
+            restart_process_pool = False
             for root, subdirs, files in await utils.run_in_executor(self, os.walk, self.AD.app_dir, topdown=True):
                 # print(root, subdirs, files)
                 #
@@ -916,6 +927,7 @@ class AppManagement:
                         self.logger.info("Adding %s to module import path", root)
                         sys.path.insert(0, root)
                         self.module_dirs.append(root)
+                        restart_process_pool = True
 
                 for file in files:
                     if file[-3:] == ".py" and file[0] != ".":
@@ -1026,6 +1038,12 @@ class AppManagement:
                                 self.logger.warning("%s", app)
                                 await self.set_state(app, state="compile_error")
 
+                if mod["reload"] and self.module_uses_process_executor(self.get_module_from_path(mod["name"])):
+                    restart_process_pool = True
+
+            if restart_process_pool:
+                self.AD.restart_process_executor()
+
             if apps is not None and apps["init"]:
 
                 prio_apps = self.get_app_deps_and_prios(apps["init"], mode)
@@ -1189,6 +1207,10 @@ class AppManagement:
 
         return apps
 
+    def module_uses_process_executor(self, module):
+        apps = self.apps_per_module(module) + self.apps_per_global_module(module)
+        return any(self.app_config[app].get("executor") == "process" for app in apps if app in self.app_config)
+
     def apps_per_global_module(self, module):
         apps = []
         for app in self.app_config:
@@ -1,6 +1,7 @@
 import os
 import os.path
 import concurrent.futures
+import multiprocessing
 import threading
 
 
@@ -32,6 +33,7 @@ class AppDaemon:
         self.callbacks = None
         self.futures = None
         self.state = None
+        self.events = None
 
         self.config = kwargs
         self.booted = "booting"
@@ -43,6 +45,8 @@ class AppDaemon:
         self.last_state = None
 
         self.executor = None
+        self.process_executor = None
+        self.process_executor_lock = threading.Lock()
         self.loop = None
         self.srv = None
         self.appd = None
@@ -107,6 +111,9 @@ class AppDaemon:
         self.threadpool_workers = 10
         utils.process_arg(self, "threadpool_workers", kwargs, int=True)
 
+        self.process_workers = None
+        utils.process_arg(self, "process_workers", kwargs, int=True)
+
         self.endtime = None
         utils.process_arg(self, "endtime", kwargs)
 
@@ -152,6 +159,18 @@ class AppDaemon:
         self.internal_function_timeout = 10
         utils.process_arg(self, "internal_function_timeout", kwargs, int=True)
 
+        self.event_queue_size = 1000
+        utils.process_arg(self, "event_queue_size", kwargs, int=True)
+
+        self.event_queue_overflow = "block"
+        utils.process_arg(self, "event_queue_overflow", kwargs)
+
+        self.state_coalescing = {}
+        utils.process_arg(self, "state_coalescing", kwargs)
+
+        self.service_batch_window = 0
+        utils.process_arg(self, "service_batch_window", kwargs, float=True)
+
         self.namespaces = {}
         utils.process_arg(self, "namespaces", kwargs)
 
@@ -271,10 +290,37 @@ class AppDaemon:
             self.utility.stop()
         if self.plugins is not None:
             self.plugins.stop()
+        if self.events is not None:
+            self.events.stop()
 
     def terminate(self):
         if self.state is not None:
             self.state.terminate()
+        with self.process_executor_lock:
+            if self.process_executor is not None:
+                self.process_executor.shutdown(wait=False)
+
+    def get_process_executor(self):
+        # Only started once an app with "executor: process" needs it. Worker processes are spawned rather than
+        # forked, as forking a process with running threads isn't safe. Called from the worker threads, so the
+        # lock stops two of them starting a pool each
+        with self.process_executor_lock:
+            if self.process_executor is None:
+                self.logger.info("Starting process pool")
+                self.process_executor = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self.process_workers, mp_context=multiprocessing.get_context("spawn")
+                )
+            return self.process_executor
+
+    def restart_process_executor(self):
+        # Worker processes keep the app modules they have imported, and the import path they were started with, so
+        # the pool is replaced when either changes. Work already submitted finishes in the old pool, and the new one
+        # is started on first use
+        with self.process_executor_lock:
+            if self.process_executor is not None:
+                self.logger.info("Restarting process pool to pick up app changes")
+                self.process_executor.shutdown(wait=False)
+                self.process_executor = None
 
     #
     # Utilities
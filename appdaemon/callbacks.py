@@ -4,6 +4,102 @@ import appdaemon.utils as utils
 from appdaemon.appdaemon import AppDaemon
 
 
+class RateLimit:
+    """Limits how often a state or event callback is dispatched.
+
+    - ``throttle``: minimum number of seconds between two calls, calls in between are dropped.
+    - ``debounce``: the call is held back until no other call has come for that many seconds, and only the latest
+      one is made.
+    - ``max_rate``: maximum number of calls per second, allowing bursts of up to that many calls.
+
+    Calls are counted against the limits when they are made, so a debounced call is also subject to the others.
+    """
+
+    KWARGS = ("throttle", "debounce", "max_rate")
+
+    def __init__(self, throttle=None, debounce=None, max_rate=None):
+        self.throttle = throttle
+        self.debounce = debounce
+        self.max_rate = max_rate
+
+        self.last_call = None
+        self.tokens = max(1.0, max_rate) if max_rate is not None else None
+        self.last_refill = None
+
+        # Latest dispatch held back by the debounce, with its timer
+        self.pending = None
+        self.handle = None
+
+    @classmethod
+    def from_kwargs(cls, kwargs):
+        """Returns a ``RateLimit`` for the callback's kwargs, or ``None`` if it has no limits.
+
+        Raises:
+            ValueError: If a limit isn't a positive number.
+        """
+
+        limits = {}
+        for key in cls.KWARGS:
+            if kwargs.get(key) is not None:
+                try:
+                    value = float(kwargs[key])
+                except (TypeError, ValueError):
+                    value = 0
+                if value <= 0:
+                    raise ValueError("{} must be a positive number, got {}".format(key, kwargs[key]))
+                limits[key] = value
+
+        if not limits:
+            return None
+        return cls(**limits)
+
+    def allow(self, now):
+        """Returns ``True`` if a call can be made now, counting it against the limits."""
+
+        if self.throttle is not None and self.last_call is not None and now - self.last_call < self.throttle:
+            return False
+
+        if self.max_rate is not None:
+            if self.last_refill is not None:
+                self.tokens = min(max(1.0, self.max_rate), self.tokens + (now - self.last_refill) * self.max_rate)
+            self.last_refill = now
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+
+        self.last_call = now
+        return True
+
+    def defer(self, loop, args, dispatch):
+        """Holds back a dispatch until the debounce window has passed without another one.
+
+        The held dispatch keeps the old state of the first one it replaces, so state callbacks still see
+        the whole change. ``dispatch`` is a coroutine function called with the latest args.
+        """
+
+        if self.pending is not None and "old_state" in args:
+            args = dict(args)
+            args["old_state"] = self.pending["old_state"]
+        self.pending = args
+
+        if self.handle is not None:
+            self.handle.cancel()
+        self.handle = loop.call_later(self.debounce, self.release, loop, dispatch)
+
+    def release(self, loop, dispatch):
+        args = self.pending
+        self.pending = None
+        self.handle = None
+        if args is not None:
+            loop.create_task(dispatch(args))
+
+    def cancel(self):
+        if self.handle is not None:
+            self.handle.cancel()
+        self.handle = None
+        self.pending = None
+
+
 class Callbacks:
     def __init__(self, ad: AppDaemon):
 
@@ -11,6 +107,24 @@ class Callbacks:
 
         self.callbacks = {}
         self.callbacks_lock = asyncio.Lock()
+
+        #
+        # Dispatch indexes, maintained by add_callback() and remove_callback() so that dispatch only
+        # has to look at the listeners that can match a given entity or event. None acts as a wildcard.
+        #
+        #   state_index:  (namespace, domain, entity_id) -> {handle: name}
+        #   event_index:  (namespace, event) -> {handle: name}
+        #   log_index:    namespace -> {handle: name}
+        #
+
+        self.state_index = {}
+        self.event_index = {}
+        self.log_index = {}
+
+        # Count of log and __AD_LOG_EVENT callbacks per app, used for log loop avoidance
+
+        self.log_listeners = {}
+
         self.logger = ad.logging.get_child("_callbacks")
         self.diag = ad.logging.get_diag()
 
@@ -68,6 +182,159 @@ class Callbacks:
                         )
         return callbacks
 
+    #
+    # Registration
+    #
+    # Both of these must be called with callbacks_lock held
+    #
+
+    def add_callback(self, name, handle, callback):
+        if self.AD.threading is not None:
+            self.AD.threading.validate_priority(name, callback["kwargs"])
+            callback["constraints"] = self.AD.threading.compile_constraints(name, callback["kwargs"])
+
+        if callback["type"] in ("state", "event"):
+            try:
+                callback["rate_limit"] = RateLimit.from_kwargs(callback["kwargs"])
+            except ValueError as e:
+                self.logger.warning("Ignoring rate limits of callback from app %s: %s", name, e)
+
+        if name not in self.callbacks:
+            self.callbacks[name] = {}
+        self.callbacks[name][handle] = callback
+        self.index_callback(name, handle, callback)
+
+    def remove_callback(self, name, handle):
+        callback = self.callbacks[name].pop(handle)
+        self.unindex_callback(handle, callback)
+        if callback.get("rate_limit") is not None:
+            callback["rate_limit"].cancel()
+        return callback
+
+    #
+    # Indexing
+    #
+
+    @staticmethod
+    def state_index_key(namespace, entity):
+        if entity is None:
+            return namespace, None, None
+        if "." not in entity:
+            return namespace, entity, None
+        return namespace, entity.split(".", 1)[0], entity
+
+    def get_index(self, callback):
+        if callback["type"] == "state":
+            return self.state_index, self.state_index_key(callback["namespace"], callback["entity"])
+        elif callback["type"] == "event":
+            return self.event_index, (callback["namespace"], callback["event"])
+        elif callback["type"] == "log":
+            return self.log_index, callback["namespace"]
+        return None, None
+
+    @staticmethod
+    def is_log_listener(callback):
+        return callback["type"] == "log" or (callback["type"] == "event" and callback["event"] == "__AD_LOG_EVENT")
+
+    def index_callback(self, name, handle, callback):
+        index, key = self.get_index(callback)
+        if index is not None:
+            index.setdefault(key, {})[handle] = name
+            if index is self.event_index and len(index[key]) == 1:
+                self.event_types_changed(callback["namespace"])
+
+        if self.is_log_listener(callback):
+            self.log_listeners[name] = self.log_listeners.get(name, 0) + 1
+
+    def unindex_callback(self, handle, callback):
+        index, key = self.get_index(callback)
+        if index is not None:
+            bucket = index.get(key)
+            if bucket is not None:
+                bucket.pop(handle, None)
+                if not bucket:
+                    del index[key]
+                    if index is self.event_index:
+                        self.event_types_changed(callback["namespace"])
+
+        if self.is_log_listener(callback):
+            name = callback["name"]
+            self.log_listeners[name] -= 1
+            if self.log_listeners[name] <= 0:
+                del self.log_listeners[name]
+
+    def event_types_changed(self, namespace):
+        # Only called when the first listener for an event type arrives or the last one goes
+        if self.AD.plugins is not None:
+            self.AD.plugins.notify_event_callbacks_changed(namespace)
+
+    def has_log_listener(self, name):
+        return name in self.log_listeners
+
+    def get_state_callbacks(self, namespace, entity_id):
+        """Returns ``(name, handle)`` for every state callback that may match ``entity_id`` in ``namespace``.
+
+        Cost scales with the number of matching listeners rather than the total number of callbacks.
+        Must be called with callbacks_lock held.
+        """
+
+        domain = entity_id.split(".", 1)[0]
+        matches = []
+
+        if namespace == "global":
+            # A global event matches listeners in every namespace
+            for key, bucket in self.state_index.items():
+                if key[1] in (None, domain) and key[2] in (None, entity_id):
+                    matches.extend((name, handle) for handle, name in bucket.items())
+            return matches
+
+        for ns in (namespace, "global"):
+            for key in ((ns, domain, entity_id), (ns, domain, None), (ns, None, None)):
+                bucket = self.state_index.get(key)
+                if bucket is not None:
+                    matches.extend((name, handle) for handle, name in bucket.items())
+
+        return matches
+
+    def get_event_callbacks(self, namespace, event):
+        """Returns ``(name, handle)`` for every event callback that may match ``event`` in ``namespace``.
+
+        Listeners registered for all events never see system events (those starting with ``__``),
+        so an event with no listeners costs a handful of dictionary lookups.
+        Must be called with callbacks_lock held.
+        """
+
+        events = (event,) if event[:2] == "__" else (event, None)
+        matches = []
+
+        if namespace == "global":
+            # A global event matches listeners in every namespace
+            for key, bucket in self.event_index.items():
+                if key[1] in events:
+                    matches.extend((name, handle) for handle, name in bucket.items())
+            return matches
+
+        for ns in (namespace, "global"):
+            for ev in events:
+                bucket = self.event_index.get((ns, ev))
+                if bucket is not None:
+                    matches.extend((name, handle) for handle, name in bucket.items())
+
+        return matches
+
+    def get_log_callbacks(self, namespace):
+        """Returns ``(name, handle)`` for every log callback that may match ``namespace``.
+
+        Must be called with callbacks_lock held.
+        """
+
+        matches = []
+        for ns, bucket in self.log_index.items():
+            if ns == namespace or ns == "global" or namespace == "global":
+                matches.extend((name, handle) for handle, name in bucket.items())
+
+        return matches
+
     async def clear_callbacks(self, name):
         self.logger.debug("Clearing callbacks for %s", name)
         async with self.callbacks_lock:
@@ -79,4 +346,7 @@ class Callbacks:
                         await self.AD.state.remove_entity("admin", "state_callback.{}".format(cid))
                     if self.callbacks[name][cid]["type"] == "log":
                         await self.AD.state.remove_entity("admin", "log_callback.{}".format(cid))
+                    self.unindex_callback(cid, self.callbacks[name][cid])
+                    if self.callbacks[name][cid].get("rate_limit") is not None:
+                        self.callbacks[name][cid]["rate_limit"].cancel()
                 del self.callbacks[name]
@@ -1,14 +1,138 @@
 """Module to handle all events within AppDaemon."""
 
 import uuid
-from copy import deepcopy
 import traceback
 import datetime
+import asyncio
+import concurrent.futures
+import time
+from collections import deque
 
 from appdaemon.appdaemon import AppDaemon
 import appdaemon.utils as utils
 
 
+class EventQueue:
+    """Bounded queue of events waiting to be processed for one namespace.
+
+    When the queue is full, ``overflow`` decides what happens to a new event:
+
+    - ``block``: the producer waits for room.
+    - ``drop_oldest``: the oldest queued event is discarded.
+    - ``coalesce``: a ``state_changed`` event for an entity that already has one queued replaces the queued
+      event's new state, otherwise the oldest queued event is discarded.
+
+    All methods must be called from the event loop.
+    """
+
+    def __init__(self, maxsize, overflow):
+        self.maxsize = maxsize
+        self.overflow = overflow
+
+        # Entries are [time queued, event]
+        self.events = deque()
+        # Latest queued entry per entity, only kept when coalescing
+        self.pending = {}
+        self.not_empty = asyncio.Event()
+        self.not_full = asyncio.Event()
+        self.not_full.set()
+
+        # Metrics
+        self.received = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.peak_depth = 0
+        self.lag = 0
+        self.peak_lag = 0
+
+    @staticmethod
+    def coalesce_key(data):
+        if data.get("event_type") == "state_changed":
+            return data.get("data", {}).get("entity_id")
+        return None
+
+    async def put(self, data):
+        self.received += 1
+
+        if len(self.events) >= self.maxsize:
+            if self.overflow == "block":
+                while len(self.events) >= self.maxsize:
+                    self.not_full.clear()
+                    await self.not_full.wait()
+            elif self.overflow == "coalesce" and self.coalesce(data):
+                return
+            else:
+                self.remove_entry(self.events.popleft())
+                self.dropped += 1
+
+        entry = [time.monotonic(), data]
+        self.events.append(entry)
+        if self.overflow == "coalesce":
+            key = self.coalesce_key(data)
+            if key is not None:
+                self.pending[key] = entry
+
+        self.peak_depth = max(self.peak_depth, len(self.events))
+        self.not_empty.set()
+
+    def coalesce(self, data):
+        entry = self.pending.get(self.coalesce_key(data))
+        if entry is None:
+            return False
+
+        # Keep the old state of the queued event, so callbacks still see the whole change
+        queued = entry[1]
+        merged = dict(data)
+        merged["data"] = dict(data["data"])
+        merged["data"]["old_state"] = queued["data"].get("old_state")
+        entry[1] = merged
+        self.coalesced += 1
+        return True
+
+    def remove_entry(self, entry):
+        key = self.coalesce_key(entry[1])
+        if key is not None and self.pending.get(key) is entry:
+            del self.pending[key]
+
+    async def get(self):
+        while not self.events:
+            self.not_empty.clear()
+            await self.not_empty.wait()
+
+        entry = self.events.popleft()
+        self.remove_entry(entry)
+        self.lag = time.monotonic() - entry[0]
+        self.peak_lag = max(self.peak_lag, self.lag)
+        self.not_full.set()
+        return entry[1]
+
+    def clear(self):
+        """Discards every queued event, returning how many there were."""
+
+        count = len(self.events)
+        self.events.clear()
+        self.pending = {}
+        self.dropped += count
+        self.not_full.set()
+        return count
+
+    def get_stats(self):
+        """Returns the queue metrics, resetting the peaks."""
+
+        stats = {
+            "depth": len(self.events),
+            "peak_depth": self.peak_depth,
+            "lag": round(self.lag, 3),
+            "peak_lag": round(self.peak_lag, 3),
+            "received": self.received,
+            "dropped": self.dropped,
+            "coalesced": self.coalesced,
+        }
+        self.peak_depth = len(self.events)
+        self.peak_lag = 0
+        return stats
+
+
 class Events:
     """Encapsulate event handling."""
 
@@ -21,6 +145,15 @@ class Events:
 
         self.AD = ad
         self.logger = ad.logging.get_child("_events")
+
+        # Plugin events waiting to be processed, and the task draining each queue, by namespace
+        self.event_queues = {}
+        self.event_consumers = {}
+        self.event_queue_stats = {}
+
+        # Coalescing rules by entity id or domain, and the state changes currently held back by entity
+        self.coalescing_rules = self.parse_coalescing_rules(self.AD.state_coalescing)
+        self.coalesced_states = {}
         #
         # Events
         #
@@ -53,20 +186,22 @@ class Events:
                 pin_thread = self.AD.app_management.objects[name]["pin_thread"]
 
             async with self.AD.callbacks.callbacks_lock:
-                if name not in self.AD.callbacks.callbacks:
-                    self.AD.callbacks.callbacks[name] = {}
                 handle = uuid.uuid4().hex
-                self.AD.callbacks.callbacks[name][handle] = {
-                    "name": name,
-                    "id": self.AD.app_management.objects[name]["id"],
-                    "type": "event",
-                    "function": cb,
-                    "namespace": namespace,
-                    "event": event,
-                    "pin_app": pin_app,
-                    "pin_thread": pin_thread,
-                    "kwargs": kwargs,
-                }
+                self.AD.callbacks.add_callback(
+                    name,
+                    handle,
+                    {
+                        "name": name,
+                        "id": self.AD.app_management.objects[name]["id"],
+                        "type": "event",
+                        "function": cb,
+                        "namespace": namespace,
+                        "event": event,
+                        "pin_app": pin_app,
+                        "pin_thread": pin_thread,
+                        "kwargs": kwargs,
+                    },
+                )
 
             if "timeout" in kwargs:
                 timeout = kwargs.pop("timeout")
@@ -116,7 +251,7 @@ class Events:
 
         async with self.AD.callbacks.callbacks_lock:
             if name in self.AD.callbacks.callbacks and handle in self.AD.callbacks.callbacks[name]:
-                del self.AD.callbacks.callbacks[name][handle]
+                self.AD.callbacks.remove_callback(name, handle)
                 await self.AD.state.remove_entity("admin", "event_callback.{}".format(handle))
                 executed = True
 
@@ -177,6 +312,228 @@ class Events:
             # Just fire the event locally
             await self.AD.events.process_event(namespace, {"event_type": event, "data": kwargs})
 
+    #
+    # Ingestion
+    #
+
+    def get_event_queue(self, namespace):
+        queue = self.event_queues.get(namespace)
+        if queue is None:
+            queue = EventQueue(self.AD.event_queue_size, self.AD.event_queue_overflow)
+            self.event_queues[namespace] = queue
+            # A single consumer per namespace keeps its events in order
+            self.event_consumers[namespace] = self.AD.loop.create_task(self.consume_events(namespace, queue))
+        return queue
+
+    def discard_queued_events(self, namespace):
+        """Discards the events still queued for a namespace whose plugin has lost its connection.
+
+        The namespace's state is refreshed in full when the plugin reconnects, so processing them afterwards would
+        overwrite the fresh state with stale changes.
+        """
+
+        queue = self.event_queues.get(namespace)
+        if queue is not None:
+            count = queue.clear()
+            if count > 0:
+                self.logger.info("Discarded %s events queued for namespace %s", count, namespace)
+
+    async def queue_event(self, namespace, data):
+        """Queues an event received by a plugin for processing.
+
+        Depending on the ``event_queue_overflow`` policy, this waits for room in the queue when it is full.
+
+        Args:
+            namespace (str): Namespace the event was fired in.
+            data: Data associated with the event.
+
+        Returns:
+            None.
+
+        """
+
+        await self.get_event_queue(namespace).put(data)
+
+    def queue_event_threadsafe(self, namespace, data):
+        """Queues an event from a plugin thread other than the event loop, blocking the thread while the queue is full.
+
+        Args:
+            namespace (str): Namespace the event was fired in.
+            data: Data associated with the event.
+
+        Returns:
+            None.
+
+        """
+
+        try:
+            on_loop = asyncio.get_running_loop() is self.AD.loop
+        except RuntimeError:
+            on_loop = False
+
+        if on_loop:
+            # Called from the loop after all, we mustn't block it
+            self.AD.loop.create_task(self.queue_event(namespace, data))
+            return
+
+        future = asyncio.run_coroutine_threadsafe(self.queue_event(namespace, data), self.AD.loop)
+        while True:
+            try:
+                return future.result(timeout=1)
+            except concurrent.futures.TimeoutError:
+                # Don't hold up a plugin thread that is being stopped
+                if self.AD.stopping:
+                    future.cancel()
+                    return
+
+    def stop(self):
+        self.logger.debug("stop() called for events")
+        for consumer in self.event_consumers.values():
+            consumer.cancel()
+        for entry in self.coalesced_states.values():
+            if entry["handle"] is not None:
+                entry["handle"].cancel()
+
+    async def consume_events(self, namespace, queue):
+        while True:
+            data = await queue.get()
+            await self.process_event(namespace, data)
+
+    async def update_event_queue_sensors(self):
+        """Publishes the event queue metrics to the admin namespace, warning about any dropped events."""
+
+        for namespace, queue in list(self.event_queues.items()):
+            stats = queue.get_stats()
+            last = self.event_queue_stats.get(namespace)
+            if stats == last:
+                continue
+
+            dropped = stats["dropped"] - (last["dropped"] if last is not None else 0)
+            if dropped > 0:
+                self.logger.warning("Event queue for namespace %s is full, dropped %s events", namespace, dropped)
+
+            self.event_queue_stats[namespace] = stats
+            await self.AD.state.set_state(
+                "_events",
+                "admin",
+                "event_queue.{}".format(namespace),
+                state=stats["depth"],
+                attributes=stats,
+                _silent=True,
+            )
+
+    #
+    # State change coalescing
+    #
+
+    def parse_coalescing_rules(self, config):
+        rules = {}
+        if not isinstance(config, dict):
+            self.logger.warning("state_coalescing should be a dictionary of entities or domains, ignoring it")
+            return rules
+
+        for key, rule in config.items():
+            modes = [mode for mode in ("interval", "debounce") if isinstance(rule, dict) and mode in rule]
+            if len(modes) != 1:
+                self.logger.warning("state_coalescing for %s needs one of 'interval' or 'debounce', ignoring it", key)
+                continue
+
+            mode = modes[0]
+            try:
+                window = float(rule[mode])
+            except (TypeError, ValueError):
+                window = 0
+
+            if window <= 0:
+                self.logger.warning("Invalid %s for state_coalescing of %s: %s, ignoring it", mode, key, rule[mode])
+                continue
+
+            rules[key] = (mode, window)
+
+        return rules
+
+    def get_coalescing_rule(self, namespace, entity_id):
+        if not self.coalescing_rules or namespace == "admin":
+            return None
+
+        rule = self.coalescing_rules.get(entity_id)
+        if rule is None:
+            rule = self.coalescing_rules.get(entity_id.split(".", 1)[0])
+        return rule
+
+    def coalesce_state_change(self, namespace, data):
+        """Holds back a state change for an entity configured in ``state_coalescing``.
+
+        With an ``interval``, a change is delivered straight away if none was delivered during the last interval,
+        otherwise the latest change is delivered when the interval is up. With a ``debounce``, the latest change is
+        delivered once the entity hasn't changed for that long. A held change keeps the old state of the first
+        change it replaces, so callbacks still see the whole transition.
+
+        Args:
+            namespace (str): Namespace of the entity.
+            data: The ``state_changed`` event.
+
+        Returns:
+            ``True`` if the change was held back, ``False`` if it should be delivered now.
+
+        """
+
+        entity_id = data["data"]["entity_id"]
+        rule = self.get_coalescing_rule(namespace, entity_id)
+        if rule is None:
+            return False
+
+        mode, window = rule
+        key = (namespace, entity_id)
+        now = self.AD.loop.time()
+        entry = self.coalesced_states.get(key)
+        if entry is None:
+            entry = {"data": None, "handle": None, "last": None}
+            self.coalesced_states[key] = entry
+
+        if entry["data"] is not None:
+            held = data
+            data = dict(held)
+            data["data"] = dict(held["data"])
+            data["data"]["old_state"] = entry["data"]["data"].get("old_state")
+        entry["data"] = data
+
+        if mode == "interval":
+            if entry["handle"] is not None:
+                # Already waiting for the end of the interval
+                return True
+
+            if entry["last"] is None or now - entry["last"] >= window:
+                entry["data"] = None
+                entry["last"] = now
+                return False
+
+            entry["handle"] = self.AD.loop.call_at(entry["last"] + window, self.release_state_change, key)
+        else:
+            if entry["handle"] is not None:
+                entry["handle"].cancel()
+            entry["handle"] = self.AD.loop.call_later(window, self.release_state_change, key)
+
+        return True
+
+    def release_state_change(self, key):
+        entry = self.coalesced_states.get(key)
+        if entry is None:
+            return
+
+        data = entry["data"]
+        entry["data"] = None
+        entry["handle"] = None
+        entry["last"] = self.AD.loop.time()
+
+        if data is not None:
+            self.AD.loop.create_task(self.notify_event(key[0], data))
+
+    def cancel_state_change(self, namespace, entity_id):
+        entry = self.coalesced_states.pop((namespace, entity_id), None)
+        if entry is not None and entry["handle"] is not None:
+            entry["handle"].cancel()
+
     async def process_event(self, namespace, data):
         """Processes an event that has been received either locally or from a plugin.
 
@@ -197,6 +554,9 @@ class Events:
             self.logger.debug("Event type:%s:", data["event_type"])
             self.logger.debug(data["data"])
 
+            # Frozen once here, so that the state record and the callbacks the event is dispatched to can share it
+            data["data"] = utils.freeze(data["data"])
+
             # Kick the scheduler so it updates it's clock
             if self.AD.sched is not None and self.AD.sched.realtime is False and namespace != "admin":
                 await self.AD.sched.kick()
@@ -206,6 +566,7 @@ class Events:
                     if data["data"]["new_state"] is None:
                         # most likely it is a deleted entity
                         entity_id = data["data"]["entity_id"]
+                        self.cancel_state_change(namespace, entity_id)
                         await self.AD.state.remove_entity_simple(namespace, entity_id)
                         return
 
@@ -213,12 +574,40 @@ class Events:
 
                     self.AD.state.set_state_simple(namespace, entity_id, data["data"]["new_state"])
 
-                    if self.AD.apps is True and namespace != "admin":
-                        await self.AD.state.process_state_callbacks(namespace, data)
+                    # The state is always kept current, but callbacks and the stream may only see the latest change
+                    if self.coalesce_state_change(namespace, data):
+                        return
                 else:
                     self.logger.warning("Malformed 'state_changed' event: %s", data["data"])
                     return
 
+            await self.notify_event(namespace, data)
+
+        except Exception:
+            self.logger.warning("-" * 60)
+            self.logger.warning("Unexpected error during process_event()")
+            self.logger.warning("-" * 60)
+            self.logger.warning(traceback.format_exc())
+            self.logger.warning("-" * 60)
+
+    async def notify_event(self, namespace, data):
+        """Delivers an event that has been processed to the callbacks and the stream.
+
+        Args:
+            namespace (str): Namespace the event was fired in.
+            data: Data associated with the event.
+
+        Returns:
+            None.
+
+        """
+
+        try:
+
+            if data["event_type"] == "state_changed":
+                if self.AD.apps is True and namespace != "admin":
+                    await self.AD.state.process_state_callbacks(namespace, data)
+
             # Check for log callbacks and exit to prevent loops
             if data["event_type"] == "__AD_LOG_EVENT":
                 if await self.has_log_callback(data["data"]["app_name"]):
@@ -243,19 +632,18 @@ class Events:
                         # Nothing changed so don't send
                         return
 
-                # take a copy without TS if present as it breaks deepcopy and jason
-                if "ts" in data["data"]:
-                    ts = data["data"].pop("ts")
-                    mydata = deepcopy(data)
-                    data["data"]["ts"] = ts
-                else:
-                    mydata = deepcopy(data)
+                #
+                # State records are copy on write, so a shallow copy is a stable snapshot for the stream.
+                # Leave out TS if present as it breaks json
+                #
+                mydata = dict(data)
+                mydata["data"] = {key: value for key, value in data["data"].items() if key != "ts"}
 
                 await self.AD.http.stream_update(namespace, mydata)
 
         except Exception:
             self.logger.warning("-" * 60)
-            self.logger.warning("Unexpected error during process_event()")
+            self.logger.warning("Unexpected error during notify_event()")
             self.logger.warning("-" * 60)
             self.logger.warning(traceback.format_exc())
             self.logger.warning("-" * 60)
@@ -271,20 +659,10 @@ class Events:
 
         """
 
-        has_log_callback = False
         if name == "AppDaemon._stream":
-            has_log_callback = True
-        else:
-            async with self.AD.callbacks.callbacks_lock:
-                for callback in self.AD.callbacks.callbacks:
-                    for _uuid in self.AD.callbacks.callbacks[callback]:
-                        cb = self.AD.callbacks.callbacks[callback][_uuid]
-                        if cb["name"] == name and cb["type"] == "event" and cb["event"] == "__AD_LOG_EVENT":
-                            has_log_callback = True
-                        elif cb["name"] == name and cb["type"] == "log":
-                            has_log_callback = True
+            return True
 
-        return has_log_callback
+        return self.AD.callbacks.has_log_listener(name)
 
     async def process_event_callbacks(self, namespace, data):
         """Processes a pure event callback.
@@ -305,74 +683,76 @@ class Events:
 
         removes = []
         async with self.AD.callbacks.callbacks_lock:
-            for name in self.AD.callbacks.callbacks.keys():
-                for uuid_ in self.AD.callbacks.callbacks[name]:
-                    callback = self.AD.callbacks.callbacks[name][uuid_]
-                    if callback["namespace"] == namespace or callback["namespace"] == "global" or namespace == "global":
-                        #
-                        # Check for either a blank event (for all events)
-                        # Or the event is a match
-                        # But don't allow a global listen for any system events (events that start with __)
-                        #
-                        if "event" in callback and (
-                            (callback["event"] is None and data["event_type"][:2] != "__")
-                            or data["event_type"] == callback["event"]
-                        ):
-
-                            # Check any filters
-
-                            _run = True
-                            for key in callback["kwargs"]:
-                                if key in data["data"]:
-                                    event_val = data["data"][key]
-                                    match_val = callback["kwargs"][key]
-
-                                    if callable(match_val):
-                                        if match_val(event_val) is not True:
-                                            _run = False
-                                    elif match_val != event_val:
-                                        _run = False
-
-                            if data["event_type"] == "__AD_LOG_EVENT":
-                                if (
-                                    "log" in callback["kwargs"]
-                                    and callback["kwargs"]["log"] != data["data"]["log_type"]
-                                ):
-                                    _run = False
-
-                            if _run:
-                                if name in self.AD.app_management.objects:
-                                    executed = await self.AD.threading.dispatch_worker(
-                                        name,
-                                        {
-                                            "id": uuid_,
-                                            "name": name,
-                                            "objectid": self.AD.app_management.objects[name]["id"],
-                                            "type": "event",
-                                            "event": data["event_type"],
-                                            "function": callback["function"],
-                                            "data": data["data"],
-                                            "pin_app": callback["pin_app"],
-                                            "pin_thread": callback["pin_thread"],
-                                            "kwargs": callback["kwargs"],
-                                        },
-                                    )
-
-                                    # Remove the callback if appropriate
-                                    if executed is True:
-                                        remove = callback["kwargs"].get("oneshot", False)
-                                        if remove is True:
-                                            removes.append({"name": name, "uuid": uuid_})
-
-                                        # remove timer if appropriate
-                                        timeout = callback["kwargs"].get("__timeout")
-                                        if timeout is not None and self.AD.sched.timer_running(name, timeout):
-                                            # means its still running so got to cancel it
-                                            await self.AD.sched.cancel_timer(name, timeout)
+            #
+            # Only visit callbacks indexed against this event type, or against all events
+            # (global listens never see system events, those that start with __)
+            #
+            for name, uuid_ in self.AD.callbacks.get_event_callbacks(namespace, data["event_type"]):
+                callback = self.AD.callbacks.callbacks[name][uuid_]
+
+                # Check any filters
+
+                _run = self.check_event_filters(callback["kwargs"], data)
+
+                if _run:
+                    if name in self.AD.app_management.objects:
+                        executed = await self.AD.threading.dispatch_rate_limited(
+                            name,
+                            {
+                                "id": uuid_,
+                                "name": name,
+                                "objectid": self.AD.app_management.objects[name]["id"],
+                                "type": "event",
+                                "event": data["event_type"],
+                                "function": callback["function"],
+                                "data": data["data"],
+                                "pin_app": callback["pin_app"],
+                                "pin_thread": callback["pin_thread"],
+                                "kwargs": callback["kwargs"],
+                                "constraints": callback.get("constraints"),
+                            },
+                            callback.get("rate_limit"),
+                        )
+
+                        # Remove the callback if appropriate
+                        if executed is True:
+                            remove = callback["kwargs"].get("oneshot", False)
+                            if remove is True:
+                                removes.append({"name": name, "uuid": uuid_})
+
+                            # remove timer if appropriate
+                            timeout = callback["kwargs"].get("__timeout")
+                            if timeout is not None and self.AD.sched.timer_running(name, timeout):
+                                # means its still running so got to cancel it
+                                await self.AD.sched.cancel_timer(name, timeout)
 
         for remove in removes:
             await self.cancel_event_callback(remove["name"], remove["uuid"])
 
+    @staticmethod
+    def check_event_filters(kwargs, data):
+        """Returns ``True`` if the event data passes every filter in the callback's kwargs.
+
+        Any kwarg whose key is also present in the event data is treated as a filter. Evaluation stops
+        at the first filter that doesn't match.
+        """
+
+        event_data = data["data"]
+        for key, match_val in kwargs.items():
+            if key in event_data:
+                event_val = event_data[key]
+                if callable(match_val):
+                    if match_val(event_val) is not True:
+                        return False
+                elif match_val != event_val:
+                    return False
+
+        if data["event_type"] == "__AD_LOG_EVENT":
+            if "log" in kwargs and kwargs["log"] != event_data["log_type"]:
+                return False
+
+        return True
+
     async def event_services(self, namespace, domain, service, kwargs):
         if "event" in kwargs:
             event = kwargs["event"]
@@ -384,4 +764,4 @@ class Events:
     @staticmethod
     def sanitize_event_kwargs(app, kwargs):
         kwargs_copy = kwargs.copy()
-        return utils._sanitize_kwargs(kwargs_copy, ["__silent"])
+        return utils._sanitize_kwargs(kwargs_copy, ["__silent", "throttle", "debounce", "max_rate", "priority"])
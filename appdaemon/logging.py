@@ -493,9 +493,6 @@ class Logging:
             #
 
             async with self.AD.callbacks.callbacks_lock:
-                if name not in self.AD.callbacks.callbacks:
-                    self.AD.callbacks.callbacks[name] = {}
-
                 # Add a separate callback for each log level
                 handles = []
                 for thislevel in self.log_levels:
@@ -503,16 +500,20 @@ class Logging:
                         handle = uuid.uuid4().hex
                         cb_kwargs = copy.deepcopy(kwargs)
                         cb_kwargs["level"] = thislevel
-                        self.AD.callbacks.callbacks[name][handle] = {
-                            "name": name,
-                            "id": self.AD.app_management.objects[name]["id"],
-                            "type": "log",
-                            "function": cb,
-                            "namespace": namespace,
-                            "pin_app": pin_app,
-                            "pin_thread": pin_thread,
-                            "kwargs": cb_kwargs,
-                        }
+                        self.AD.callbacks.add_callback(
+                            name,
+                            handle,
+                            {
+                                "name": name,
+                                "id": self.AD.app_management.objects[name]["id"],
+                                "type": "log",
+                                "function": cb,
+                                "namespace": namespace,
+                                "pin_app": pin_app,
+                                "pin_thread": pin_thread,
+                                "kwargs": cb_kwargs,
+                            },
+                        )
 
                         handles.append(handle)
 
@@ -562,43 +563,40 @@ class Logging:
 
         removes = []
         async with self.AD.callbacks.callbacks_lock:
-            for name in self.AD.callbacks.callbacks.keys():
-                for uuid_ in self.AD.callbacks.callbacks[name]:
-                    callback = self.AD.callbacks.callbacks[name][uuid_]
-                    if callback["type"] == "log" and (
-                        callback["namespace"] == namespace or callback["namespace"] == "global" or namespace == "global"
-                    ):
-
-                        # Check any filters
-                        _run = True
-                        if "log" in callback["kwargs"] and callback["kwargs"]["log"] != data["log_type"]:
-                            _run = False
-
-                        if "level" in callback["kwargs"] and callback["kwargs"]["level"] != data["level"]:
-                            _run = False
-
-                        if _run:
-                            if name in self.AD.app_management.objects:
-                                executed = await self.AD.threading.dispatch_worker(
-                                    name,
-                                    {
-                                        "id": uuid_,
-                                        "name": name,
-                                        "objectid": self.AD.app_management.objects[name]["id"],
-                                        "type": "log",
-                                        "function": callback["function"],
-                                        "data": data,
-                                        "pin_app": callback["pin_app"],
-                                        "pin_thread": callback["pin_thread"],
-                                        "kwargs": callback["kwargs"],
-                                    },
-                                )
-
-                                # Remove the callback if appropriate
-                                if executed is True:
-                                    remove = callback["kwargs"].get("oneshot", False)
-                                    if remove is True:
-                                        removes.append({"name": callback["name"], "uuid": uuid_})
+            for name, uuid_ in self.AD.callbacks.get_log_callbacks(namespace):
+                callback = self.AD.callbacks.callbacks[name][uuid_]
+
+                # Check any filters
+                _run = True
+                if "log" in callback["kwargs"] and callback["kwargs"]["log"] != data["log_type"]:
+                    _run = False
+
+                if "level" in callback["kwargs"] and callback["kwargs"]["level"] != data["level"]:
+                    _run = False
+
+                if _run:
+                    if name in self.AD.app_management.objects:
+                        executed = await self.AD.threading.dispatch_worker(
+                            name,
+                            {
+                                "id": uuid_,
+                                "name": name,
+                                "objectid": self.AD.app_management.objects[name]["id"],
+                                "type": "log",
+                                "function": callback["function"],
+                                "data": data,
+                                "pin_app": callback["pin_app"],
+                                "pin_thread": callback["pin_thread"],
+                                "kwargs": callback["kwargs"],
+                                "constraints": callback.get("constraints"),
+                            },
+                        )
+
+                        # Remove the callback if appropriate
+                        if executed is True:
+                            remove = callback["kwargs"].get("oneshot", False)
+                            if remove is True:
+                                removes.append({"name": callback["name"], "uuid": uuid_})
 
         for remove in removes:
             await self.cancel_log_callback(remove["name"], remove["uuid"])
@@ -623,7 +621,7 @@ class Logging:
         async with self.AD.callbacks.callbacks_lock:
             for handle in handles:
                 if name in self.AD.callbacks.callbacks and handle in self.AD.callbacks.callbacks[name]:
-                    del self.AD.callbacks.callbacks[name][handle]
+                    self.AD.callbacks.remove_callback(name, handle)
                     await self.AD.state.remove_entity("admin", "log_callback.{}".format(handle))
                     executed = True
                 if name in self.AD.callbacks.callbacks and self.AD.callbacks.callbacks[name] == {}:
@@ -148,6 +148,16 @@ class Plugins:
             if hasattr(self.plugin_objs[plugin]["object"].utility(), "utility"):
                 self.plugin_objs[plugin]["object"].utility()
 
+    def notify_event_callbacks_changed(self, namespace):
+        #
+        # Let plugins that filter events at the source know that the events apps listen to have changed
+        #
+        for plugin in self.plugin_objs:
+            if namespace in (plugin, "global") and hasattr(
+                self.plugin_objs[plugin]["object"], "event_callbacks_changed"
+            ):
+                self.plugin_objs[plugin]["object"].event_callbacks_changed()
+
     def process_meta(self, meta, namespace):
 
         if meta is not None:
@@ -295,6 +305,16 @@ class Plugins:
                 if datetime.datetime.now() - self.last_plugin_state[plugin] > datetime.timedelta(
                     seconds=self.plugins[name]["refresh_delay"]
                 ):
+                    plugin_obj = self.plugin_objs[plugin]["object"]
+                    if (
+                        self.plugins[name].get("refresh_while_connected", True) is False
+                        and hasattr(plugin_obj, "event_stream_healthy")
+                        and plugin_obj.event_stream_healthy()
+                    ):
+                        # We are getting every change as it happens, so there is nothing to catch up on
+                        self.last_plugin_state[plugin] = datetime.datetime.now()
+                        continue
+
                     try:
                         self.logger.debug("Refreshing %s state", name)
 
@@ -311,7 +331,18 @@ class Plugins:
                             else:
                                 namespace = plugin
 
-                            self.AD.state.update_namespace_state(namespace, state)
+                            changes = self.AD.state.update_namespace_state(namespace, state)
+                            self.logger.debug("Refreshed %s state, %s entities changed", name, len(changes))
+
+                            #
+                            # Anything that changed was missed by the event stream, so let the apps know
+                            #
+                            for ns, entity_id, old_state, new_state in changes:
+                                data = {
+                                    "event_type": "state_changed",
+                                    "data": {"entity_id": entity_id, "new_state": new_state, "old_state": old_state},
+                                }
+                                await self.AD.events.process_event(ns, data)
 
                     except asyncio.TimeoutError:
                         self.logger.warning(
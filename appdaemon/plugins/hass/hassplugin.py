@@ -1,13 +1,13 @@
 import asyncio
 import json
 import ssl
-import websocket
 import traceback
 import aiohttp
 import pytz
 from deepdiff import DeepDiff
 from copy import deepcopy
 import datetime
+import itertools
 from urllib.parse import quote
 from urllib.parse import urlencode
 from typing import Union
@@ -55,6 +55,8 @@ class HassPlugin(PluginBase):
         self.cert_path = args.get("cert_path")
         self.cert_verify = args.get("cert_verify")
         self.commtype = args.get("commtype", "WS")
+        self.event_subscription = args.get("event_subscription", "all")
+        self.service_calls = args.get("service_calls", "rest")
         self.ha_key = args.get("ha_key")
         self.ha_url = args.get("ha_url", "")
         self.namespace = args.get("namespace", "default")
@@ -66,6 +68,17 @@ class HassPlugin(PluginBase):
         # Connections to HA
         self._session = None  # http connection pool for general use
         self.ws = None  # websocket dedicated for event loop
+        self.ws_reader = None  # task reading from the websocket
+        self.ws_events = None  # events read from the websocket, in order
+        self.ws_ids = itertools.count(1)
+        self.ws_requests = {}  # request id -> future for the result
+
+        # Event subscriptions, keyed by the id of the subscribe request. An event type of None means all events
+        self.subscriptions = {}
+        self.pending_subscriptions = {}
+        self.all_events_subscribed = False
+        self.subscriptions_changed = False
+        self.subscription_task = None
 
         # Cached state from HA
         self.metadata = None
@@ -87,7 +100,7 @@ class HassPlugin(PluginBase):
         self.logger.debug("stop() called for %s", self.name)
         self.stopping = True
         if self.ws is not None:
-            self.ws.close()
+            asyncio.run_coroutine_threadsafe(self.ws.close(), self.AD.loop)
 
     #
     # Placeholder for constraints
@@ -126,43 +139,203 @@ class HassPlugin(PluginBase):
     # Connect and return a new WebSocket to HASS instance
     #
     async def create_websocket(self):
-        # change to websocket protocol
-        url = self.ha_url
-        if url.startswith("https://"):
-            url = url.replace("https", "wss", 1)
-        elif url.startswith("http://"):
-            url = url.replace("http", "ws", 1)
-
-        # ssl options
-        sslopt = {}
-        if self.cert_verify is False:
-            sslopt = {"cert_reqs": ssl.CERT_NONE}
-        if self.cert_path:
-            sslopt["ca_certs"] = self.cert_path
-        ws = websocket.create_connection("{}/api/websocket".format(url), sslopt=sslopt)
-
-        # wait for successful connection
-        res = await utils.run_in_executor(self, ws.recv)
-        result = json.loads(res)
-        self.logger.info("Connected to Home Assistant %s", result["ha_version"])
-
-        # Check if auth required, if so send password
-        if result["type"] == "auth_required":
-            if self.token is not None:
-                auth = json.dumps({"type": "auth", "access_token": self.token})
-            elif self.ha_key is not None:
-                auth = json.dumps({"type": "auth", "api_password": self.ha_key})
-            else:
-                raise ValueError("HASS requires authentication and none provided in plugin config")
+        # Use the session's connection pool and ssl settings, aiohttp takes care of the ws:// or wss:// upgrade.
+        # Messages such as the initial states can be large, so don't limit their size
+        ws = await self.session.ws_connect("/api/websocket", max_msg_size=0)
+
+        try:
+            # wait for successful connection
+            result = await self.receive_ws_message(ws)
+            self.logger.info("Connected to Home Assistant %s", result["ha_version"])
+
+            # Check if auth required, if so send password
+            if result["type"] == "auth_required":
+                if self.token is not None:
+                    auth = {"type": "auth", "access_token": self.token}
+                elif self.ha_key is not None:
+                    auth = {"type": "auth", "api_password": self.ha_key}
+                else:
+                    raise ValueError("HASS requires authentication and none provided in plugin config")
 
-            await utils.run_in_executor(self, ws.send, auth)
-            result = json.loads(ws.recv())
-            if result["type"] != "auth_ok":
-                self.logger.warning("Error in authentication")
-                raise ValueError("Error in authentication")
+                await ws.send_json(auth)
+                result = await self.receive_ws_message(ws)
+                if result["type"] != "auth_ok":
+                    self.logger.warning("Error in authentication")
+                    raise ValueError("Error in authentication")
+        except Exception:
+            await ws.close()
+            raise
 
         return ws
 
+    @staticmethod
+    async def receive_ws_message(ws):
+        msg = await ws.receive()
+        if msg.type == aiohttp.WSMsgType.TEXT:
+            return json.loads(msg.data)
+        raise ValueError("Unexpected websocket message from Home Assistant: {}".format(msg.type))
+
+    #
+    # Read messages from the websocket until it closes. Results are matched to their requests by id. Once AppDaemon
+    # is reading messages, subscribed events go straight to the namespace's bounded event queue, so that when it is
+    # full its overflow policy also holds up reading the websocket. Everything else is queued for get_updates()
+    # in the order it arrived, and events wait for get_updates() to finish with those to stay in order
+    #
+    async def read_ws_messages(self, ws, events):
+        try:
+            while True:
+                result = await self.receive_ws_message(ws)
+                if result.get("type") == "result":
+                    self.process_ws_result(result)
+                elif (
+                    self.reading_messages is True
+                    and result.get("type") == "event"
+                    and self.is_subscribed_event(result["id"])
+                    and result["event"].get("event_type") != "service_registered"
+                ):
+                    await events.join()
+                    await self.queue_ws_event(result)
+                else:
+                    events.put_nowait(result)
+        except Exception as e:
+            events.put_nowait(e)
+        finally:
+            for future in self.ws_requests.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("Disconnected from Home Assistant"))
+            self.ws_requests = {}
+            self.pending_subscriptions = {}
+
+    async def queue_ws_event(self, result):
+        metadata = {}
+        metadata["origin"] = result["event"].pop("origin", None)
+        metadata["time_fired"] = result["event"].pop("time_fired", None)
+        metadata["context"] = result["event"].pop("context", None)
+        result["event"]["data"]["metadata"] = metadata
+
+        await self.AD.events.queue_event(self.namespace, result["event"])
+
+    def process_ws_result(self, result):
+        #
+        # Subscriptions are updated here rather than by the requester, so that they are
+        # in step with the events that follow the result on the websocket
+        #
+        change = self.pending_subscriptions.pop(result["id"], None)
+        if change is not None and result.get("success") is True:
+            action, value = change
+            if action == "subscribe":
+                self.subscriptions[result["id"]] = value
+            else:
+                self.subscriptions.pop(value, None)
+            self.all_events_subscribed = None in self.subscriptions.values()
+
+        future = self.ws_requests.pop(result["id"], None)
+        if future is not None and not future.done():
+            future.set_result(result)
+
+    async def ws_request(self, message, subscription=None):
+        request_id = next(self.ws_ids)
+        message["id"] = request_id
+        future = self.AD.loop.create_future()
+        self.ws_requests[request_id] = future
+        if subscription is not None:
+            self.pending_subscriptions[request_id] = subscription
+        try:
+            await self.ws.send_json(message, dumps=utils.convert_json)
+            return await future
+        finally:
+            self.ws_requests.pop(request_id, None)
+
+    #
+    # Event subscriptions
+    #
+    async def subscribe_events(self, event_type=None):
+        message = {"type": "subscribe_events"}
+        if event_type is not None:
+            message["event_type"] = event_type
+
+        result = await self.ws_request(message, subscription=("subscribe", event_type))
+        if result["success"] is not True:
+            self.logger.warning("Unable to subscribe to HA events, event_type = %s", event_type)
+            self.logger.warning(result)
+            raise ValueError("Error subscribing to HA Events")
+
+    async def unsubscribe_events(self, subscription):
+        result = await self.ws_request(
+            {"type": "unsubscribe_events", "subscription": subscription}, subscription=("unsubscribe", subscription)
+        )
+        if result["success"] is not True:
+            self.logger.warning("Unable to unsubscribe from HA events, subscription = %s", subscription)
+            self.logger.warning(result)
+
+    def is_subscribed_event(self, subscription):
+        if subscription not in self.subscriptions:
+            # We already unsubscribed
+            return False
+        # While subscribed to all events, events from per type subscriptions are duplicates
+        return not self.all_events_subscribed or self.subscriptions[subscription] is None
+
+    def get_wanted_event_types(self):
+        if self.event_subscription != "filtered":
+            return {None}
+
+        # state_changed drives entity state, service_registered drives service registration
+        wanted = {"state_changed", "service_registered"}
+
+        for conditions in (self.plugin_startup_conditions, self.appdaemon_startup_conditions):
+            if "event" in conditions:
+                wanted.add(conditions["event"]["event_type"])
+
+        for namespace, event in list(self.AD.callbacks.event_index):
+            if namespace not in (self.namespace, "global"):
+                continue
+            if event is None:
+                # Someone is listening to all events
+                return {None}
+            if event[:2] != "__":
+                wanted.add(event)
+
+        return wanted
+
+    async def update_event_subscriptions(self):
+        #
+        # Bring HA's subscriptions in line with the event types we need, going round again if
+        # callbacks changed while we were waiting on HA. New subscriptions are made before old ones
+        # are dropped so that no events are missed.
+        #
+        while True:
+            self.subscriptions_changed = False
+            wanted = self.get_wanted_event_types()
+            current = {event_type: subscription for subscription, event_type in self.subscriptions.items()}
+
+            for event_type in wanted - current.keys():
+                await self.subscribe_events(event_type)
+            for event_type in current.keys() - wanted:
+                await self.unsubscribe_events(current[event_type])
+
+            self.logger.debug("Subscribed to HA events: %s", sorted(wanted, key=str))
+
+            if not self.subscriptions_changed:
+                break
+
+    def event_callbacks_changed(self):
+        if self.event_subscription != "filtered" or self.ws_reader is None or self.ws_reader.done():
+            return
+
+        self.subscriptions_changed = True
+        if self.subscription_task is None or self.subscription_task.done():
+            self.subscription_task = asyncio.create_task(self.run_subscription_update())
+
+    async def run_subscription_update(self):
+        try:
+            await self.update_event_subscriptions()
+        except Exception:
+            self.logger.warning("-" * 60)
+            self.logger.warning("Unexpected error updating HA event subscriptions")
+            self.logger.warning("-" * 60)
+            self.logger.warning(traceback.format_exc())
+            self.logger.warning("-" * 60)
+
     #
     # Get initial state
     #
@@ -293,7 +466,6 @@ class HassPlugin(PluginBase):
 
     async def get_updates(self):  # noqa: C901
 
-        _id = 0
         self.already_notified = False
         self.first_time = True
 
@@ -318,23 +490,21 @@ class HassPlugin(PluginBase):
         #
 
         while not self.stopping:
-            _id += 1
             try:
                 #
                 # Connect to websocket interface
                 #
                 self.ws = await self.create_websocket()
+                self.ws_events = asyncio.Queue()
+                self.subscriptions = {}
+                self.all_events_subscribed = False
+                self.ws_reader = asyncio.create_task(self.read_ws_messages(self.ws, self.ws_events))
 
                 #
-                # Subscribe to event stream
+                # Subscribe to event stream - all events, or just the ones we need if filtered
                 #
-                sub = json.dumps({"id": _id, "type": "subscribe_events"})
-                await utils.run_in_executor(self, self.ws.send, sub)
-                result = json.loads(self.ws.recv())
-                if not (result["id"] == _id and result["type"] == "result" and result["success"] is True):
-                    self.logger.warning("Unable to subscribe to HA events, id = %s", _id)
-                    self.logger.warning(result)
-                    raise ValueError("Error subscribing to HA Events")
+                self.subscription_task = asyncio.create_task(self.update_event_subscriptions())
+                await self.subscription_task
 
                 #
                 # Grab Metadata
@@ -346,13 +516,14 @@ class HassPlugin(PluginBase):
                 self.services = await self.get_hass_services()
                 for hass_service in self.services:
                     domain = hass_service["domain"]
-                    for service in hass_service["services"]:
+                    for service, service_data in hass_service["services"].items():
                         self.AD.services.register_service(
                             self.get_namespace(),
                             domain,
                             service,
                             self.call_plugin_service,
                             __silent=True,
+                            __batch=self.is_entity_service(service_data),
                         )
 
                 # Decide if we can start yet
@@ -376,42 +547,30 @@ class HassPlugin(PluginBase):
                 # Loop forever consuming events
                 #
                 while not self.stopping:
-                    ret = await utils.run_in_executor(self, self.ws.recv)
-                    result = json.loads(ret)
-
-                    if not (result["id"] == _id and result["type"] == "event"):
-                        self.logger.warning("Unexpected result from Home Assistant, id = %s", _id)
-                        self.logger.warning(result)
-
-                    if self.reading_messages is False:
-                        if result["type"] == "event":
-                            await self.evaluate_started(False, self.hass_booting, result["event"])
-                        else:
-                            await self.evaluate_started(False, self.hass_booting)
-                    else:
-                        metadata = {}
-                        metadata["origin"] = result["event"].pop("origin", None)
-                        metadata["time_fired"] = result["event"].pop("time_fired", None)
-                        metadata["context"] = result["event"].pop("context", None)
-                        result["event"]["data"]["metadata"] = metadata
+                    result = await self.ws_events.get()
+                    if isinstance(result, Exception):
+                        raise result
 
-                        await self.AD.events.process_event(self.namespace, result["event"])
-
-                        if result["event"].get("event_type") == "service_registered":
-                            data = result["event"]["data"]
-                            domain = data.get("domain")
-                            service = data.get("service")
-
-                            if domain is None or service is None:
-                                continue
-
-                            await self.check_register_service(domain, service)
+                    try:
+                        await self.process_ws_event(result)
+                    finally:
+                        self.ws_events.task_done()
 
                 self.reading_messages = False
 
             except Exception:
                 self.reading_messages = False
                 self.hass_booting = True
+                # make sure the old connection doesn't linger before we reconnect
+                if self.ws is not None:
+                    await self.ws.close()
+                if self.ws_reader is not None:
+                    # It may be waiting for get_updates() to finish with events it will now never get to
+                    self.ws_reader.cancel()
+                    await asyncio.gather(self.ws_reader, return_exceptions=True)
+                    self.ws_reader = None
+                # Events still queued would otherwise be applied over the state refreshed on reconnecting
+                self.AD.events.discard_queued_events(self.namespace)
                 # remove callback from getting local events
                 await self.AD.callbacks.clear_callbacks(self.name)
 
@@ -432,6 +591,30 @@ class HassPlugin(PluginBase):
 
         self.logger.info("Disconnecting from Home Assistant")
 
+    async def process_ws_event(self, result):
+        if result.get("type") != "event":
+            self.logger.warning("Unexpected result from Home Assistant, id = %s", result.get("id"))
+            self.logger.warning(result)
+            return
+
+        if not self.is_subscribed_event(result["id"]):
+            return
+
+        if self.reading_messages is False:
+            await self.evaluate_started(False, self.hass_booting, result["event"])
+        else:
+            await self.queue_ws_event(result)
+
+            if result["event"].get("event_type") == "service_registered":
+                data = result["event"]["data"]
+                domain = data.get("domain")
+                service = data.get("service")
+
+                if domain is None or service is None:
+                    return
+
+                await self.check_register_service(domain, service)
+
     def get_namespace(self):
         return self.namespace
 
@@ -514,6 +697,9 @@ class HassPlugin(PluginBase):
         elif domain == "database":
             return await self.get_history(**data)
 
+        elif self.service_calls == "websocket" and self.ws_connected():
+            return await self.call_ws_service(namespace, domain, service, data)
+
         else:
             api_url = "/api/services/{}/{}".format(domain, service)
 
@@ -557,6 +743,38 @@ class HassPlugin(PluginBase):
             self.logger.error("-" * 60)
             return None
 
+    def ws_connected(self):
+        return self.ws_reader is not None and not self.ws_reader.done()
+
+    def event_stream_healthy(self):
+        return self.reading_messages and self.ws_connected()
+
+    async def call_ws_service(self, namespace, domain, service, data):
+        #
+        # Calls share the event websocket, each waiting on the result with its own id,
+        # so any number of them can be in flight at once
+        #
+        try:
+            result = await self.ws_request(
+                {"type": "call_service", "domain": domain, "service": service, "service_data": data}
+            )
+        except ConnectionError:
+            self.logger.warning("HASS Disconnected unexpectedly during call_service()")
+            return None
+
+        if result["success"] is not True:
+            self.logger.warning(
+                "Error calling Home Assistant service %s/%s/%s",
+                namespace,
+                domain,
+                service,
+            )
+            error = result.get("error", {})
+            self.logger.warning("Code: %s, error: %s", error.get("code"), error.get("message"))
+            return None
+
+        return result["result"]
+
     async def get_history(self, **kwargs):
         """Used to get HA's History"""
 
@@ -654,7 +872,11 @@ class HassPlugin(PluginBase):
         self.logger.debug("get_ha_state: url is %s", api_url)
         r = await self.session.get(api_url)
         if r.status == 200 or r.status == 201:
-            state = await r.json()
+            if entity_id is None:
+                # The complete state can be several MB, so decode it off the loop
+                state = await utils.run_in_executor(self, json.loads, await r.text())
+            else:
+                state = await r.json()
         else:
             self.logger.warning("Error getting Home Assistant state for %s", entity_id)
             txt = await r.text()
@@ -769,6 +991,11 @@ class HassPlugin(PluginBase):
 
                 await self.check_register_service(domain, services)
 
+    @staticmethod
+    def is_entity_service(service_data) -> bool:
+        # Services that target entities accept a list of entity_ids, so calls to them can be batched
+        return isinstance(service_data, dict) and "target" in service_data
+
     async def check_register_service(self, domain: str, services: Union[dict, str]) -> bool:
         """Used to check and register a service if need be"""
 
@@ -812,6 +1039,7 @@ class HassPlugin(PluginBase):
                         service,
                         self.call_plugin_service,
                         __silent=True,
+                        __batch=self.is_entity_service(service_data),
                     )
 
         return domain_exists
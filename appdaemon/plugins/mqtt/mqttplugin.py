@@ -198,7 +198,7 @@ class MqttPlugin(PluginBase):
                     "event_type": self.mqtt_event_name,
                     "data": {"state": "Connected", "topic": None, "wildcard": None},
                 }
-                self.loop.create_task(self.send_ad_event(data))
+                self.AD.events.queue_event_threadsafe(self.namespace, data)
 
             elif rc == 1:
                 err_msg = "Connection was refused due to Incorrect Protocol Version"
@@ -240,7 +240,7 @@ class MqttPlugin(PluginBase):
                     "event_type": self.mqtt_event_name,
                     "data": {"state": "Disconnected", "topic": None, "wildcard": None},
                 }
-                self.loop.create_task(self.send_ad_event(data))
+                self.AD.events.queue_event_threadsafe(self.namespace, data)
             return
         except Exception:
             self.logger.critical("There was an error while disconnecting from the Mqtt Service")
@@ -275,7 +275,7 @@ class MqttPlugin(PluginBase):
                 "data": data,
             }
 
-            self.loop.create_task(self.send_ad_event(event_data))
+            self.AD.events.queue_event_threadsafe(self.namespace, event_data)
 
         except UnicodeDecodeError:
             self.logger.info("Unable to decode MQTT message")
@@ -454,7 +454,7 @@ class MqttPlugin(PluginBase):
         return self.mqtt_connected
 
     async def send_ad_event(self, data):
-        await self.AD.events.process_event(self.namespace, data)
+        await self.AD.events.queue_event(self.namespace, data)
 
     #
     # Get initial state
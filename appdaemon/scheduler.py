@@ -6,7 +6,11 @@ import random
 import uuid
 import re
 import asyncio
+import bisect
+import heapq
+import itertools
 import logging
+import math
 from collections import OrderedDict
 
 import appdaemon.utils as utils
@@ -24,10 +28,22 @@ class Scheduler:
         self.last_fired = None
         self.sleep_task = None
         self.active = False
-        self.timer_resetted = False
         self.location = None
         self.schedule = {}
 
+        #
+        # Timer queue - a heap of (timestamp, seq, name, handle) ordered by due time.
+        # Entries are never removed from the middle of the heap; cancelling or rescheduling a timer just
+        # updates queued_timers, and stale heap entries are discarded lazily when they reach the top, or all at
+        # once by compact_timers() when they make up most of the heap.
+        #
+        self.timer_queue = []
+        self.queued_timers = {}  # handle -> seq of the live heap entry
+        self.timer_seq = itertools.count()
+
+        # Next DST transition per timezone, as (computed_from, transition)
+        self.dst_transitions = {}
+
         self.now = pytz.utc.localize(datetime.datetime.utcnow())
 
         #
@@ -139,6 +155,12 @@ class Scheduler:
             "kwargs": kwargs,
         }
 
+        if callback is not None:
+            self.AD.threading.validate_priority(name, kwargs)
+            self.schedule[name][handle]["constraints"] = self.AD.threading.compile_constraints(name, kwargs)
+
+        self.queue_timer(name, handle)
+
         if callback is None:
             function_name = "cancel_callback"
         else:
@@ -162,7 +184,8 @@ class Scheduler:
         )
         # verbose_log(conf.logger, "INFO", conf.schedule[name][handle])
 
-        if self.active is True:
+        # Only wake the loop if the new timer is due before everything else already queued
+        if self.active is True and self.is_next_timer(handle):
             await self.kick()
 
         return handle
@@ -172,6 +195,7 @@ class Scheduler:
         self.logger.debug("Canceling timer for %s", name)
         if self.timer_running(name, handle):
             del self.schedule[name][handle]
+            self.queued_timers.pop(handle, None)
             await self.AD.state.remove_entity("admin", f"scheduler_callback.{handle}")
             executed = True
 
@@ -239,15 +263,14 @@ class Scheduler:
 
             args = await self.restart_timer(handle, args, restart_offset)
             self.schedule[name][handle] = args
+            self.queue_timer(name, handle)
 
-            if self.active is True:
+            # Only wake the loop if this timer is now the next one due
+            if self.active is True and self.is_next_timer(handle):
                 await self.kick()
 
             executed = True
 
-            # we need to indicate a reset took place
-            self.timer_resetted = True
-
         if not executed:
             self.logger.warning(
                 f"The given handle '{handle}' in reset_timer() from app {name}, doesn't have a running timer"
@@ -292,6 +315,7 @@ class Scheduler:
                         "pin_app": args["pin_app"],
                         "pin_thread": args["pin_thread"],
                         "kwargs": args["kwargs"],
+                        "constraints": args.get("constraints"),
                     },
                 )
 
@@ -335,18 +359,22 @@ class Scheduler:
                         "pin_app": args["pin_app"],
                         "pin_thread": args["pin_thread"],
                         "kwargs": args["kwargs"],
+                        "constraints": args.get("constraints"),
                     },
                 )
             # If it is a repeating entry, rewrite with new timestamp
             if args["repeat"]:
                 # restart the timer
                 args = await self.restart_timer(uuid_, args)
+                if self.timer_running(name, uuid_):
+                    self.queue_timer(name, uuid_)
 
             else:
                 # Otherwise just delete
                 await self.AD.state.remove_entity("admin", "scheduler_callback.{}".format(uuid_))
 
                 del self.schedule[name][uuid_]
+                self.queued_timers.pop(uuid_, None)
 
         except Exception:
             error_logger = logging.getLogger("Error.{}".format(name))
@@ -362,6 +390,7 @@ class Scheduler:
             error_logger.warning("-" * 60)
             await self.AD.state.remove_entity("admin", "scheduler_callback.{}".format(uuid_))
             del self.schedule[name][uuid_]
+            self.queued_timers.pop(uuid_, None)
 
     def init_sun(self):
         latitude = self.AD.latitude
@@ -437,6 +466,7 @@ class Scheduler:
         if name in self.schedule:
             for id in self.schedule[name]:
                 await self.AD.state.remove_entity("admin", "scheduler_callback.{}".format(id))
+                self.queued_timers.pop(id, None)
             del self.schedule[name]
 
     def is_realtime(self):
@@ -446,24 +476,68 @@ class Scheduler:
     # Timer
     #
 
+    def queue_timer(self, name, handle):
+        """Pushes the current timestamp of a schedule entry onto the timer queue.
+
+        Must be called whenever an entry is added or its timestamp changes. Any previous heap entry for the
+        same handle becomes stale and is skipped when it reaches the top of the queue.
+        """
+
+        seq = next(self.timer_seq)
+        self.queued_timers[handle] = seq
+        heapq.heappush(self.timer_queue, (self.schedule[name][handle]["timestamp"], seq, name, handle))
+
+        # Long timers that are cancelled or reset over and over would otherwise leave their stale entries behind
+        stale = len(self.timer_queue) - len(self.queued_timers)
+        if stale > 64 and stale > len(self.timer_queue) // 2:
+            self.compact_timers()
+
+    def compact_timers(self):
+        # Keeps the live entries only, unlike requeue_all_timers() which would also requeue the due entries
+        # that pop_due_entries() has handed out but that haven't run yet
+        self.timer_queue = [entry for entry in self.timer_queue if self.queued_timers.get(entry[3]) == entry[1]]
+        heapq.heapify(self.timer_queue)
+
+    def requeue_all_timers(self):
+        self.timer_queue = []
+        self.queued_timers = {}
+        for name in self.schedule:
+            for handle in self.schedule[name]:
+                seq = next(self.timer_seq)
+                self.queued_timers[handle] = seq
+                self.timer_queue.append((self.schedule[name][handle]["timestamp"], seq, name, handle))
+        heapq.heapify(self.timer_queue)
+
+    def discard_stale_timers(self):
+        while self.timer_queue and self.queued_timers.get(self.timer_queue[0][3]) != self.timer_queue[0][1]:
+            heapq.heappop(self.timer_queue)
+
+    def is_next_timer(self, handle):
+        self.discard_stale_timers()
+        return len(self.timer_queue) > 0 and self.timer_queue[0][3] == handle
+
     def get_next_entries(self):
+        self.discard_stale_timers()
 
-        next_exec = datetime.datetime.now(pytz.utc).replace(year=datetime.MAXYEAR, month=12, day=31)
-        for name in self.schedule.keys():
-            for entry in self.schedule[name].keys():
-                if self.schedule[name][entry]["timestamp"] < next_exec:
-                    next_exec = self.schedule[name][entry]["timestamp"]
+        if not self.timer_queue:
+            return []
 
-        next_entries = []
+        timestamp, seq, name, handle = self.timer_queue[0]
+        return [{"name": name, "uuid": handle, "timestamp": timestamp}]
 
-        for name in self.schedule.keys():
-            for entry in self.schedule[name].keys():
-                if self.schedule[name][entry]["timestamp"] == next_exec:
-                    next_entries.append(
-                        {"name": name, "uuid": entry, "timestamp": self.schedule[name][entry]["timestamp"]}
-                    )
+    def pop_due_entries(self):
+        """Removes and returns every live timer due at or before the scheduler's current time, in due order."""
 
-        return next_entries
+        due = []
+        while True:
+            self.discard_stale_timers()
+            if not self.timer_queue or self.timer_queue[0][0] > self.now:
+                break
+            timestamp, seq, name, handle = heapq.heappop(self.timer_queue)
+            del self.queued_timers[handle]
+            due.append({"name": name, "uuid": handle, "timestamp": timestamp})
+
+        return due
 
     async def process_dst(self, old, new):
         #
@@ -484,25 +558,75 @@ class Scheduler:
                         args["basetime"] += offset
                 self.logger.debug("After rewrite: %s", args)
 
+        self.requeue_all_timers()
+
     def get_next_dst_offset(self, base, limit):
         #
-        # I can't believe there isn't a better way to find the next DST transition but ...
-        # We know the lower and upper bounds of DST so do a search to find the actual transition time
-        # I don't want to rely on heuristics such as "it occurs at 2am" because I don't know if that holds
-        # true for every timezone. With this method, as long as pytz's dst() function is correct, this should work
+        # Returns the number of whole seconds from base until the DST state of our timezone changes,
+        # or limit if that doesn't happen within limit seconds
         #
-
-        # TODO: Convert this to some sort of binary search for efficiency
-        # TODO: This really should support sub 1 second periods better
         self.logger.debug("get_next_dst_offset() base=%s limit=%s", base, limit)
-        current = base.astimezone(self.AD.tz).dst()
-        self.logger.debug("current=%s", current)
-        for offset in range(1, int(limit) + 1):
-            candidate = (base + timedelta(seconds=offset)).astimezone(self.AD.tz)
-            # print(candidate)
-            if candidate.dst() != current:
-                return offset
-        return limit
+        transition = self.get_next_dst_transition(base)
+        self.logger.debug("next dst transition=%s", transition)
+        if transition is None:
+            return limit
+
+        offset = max(1, math.ceil((transition - base).total_seconds()))
+        return offset if offset <= limit else limit
+
+    def get_next_dst_transition(self, base):
+        #
+        # Find the first UTC instant after base where dst() differs from its value at base.
+        # The result is cached per timezone and reused for as long as base hasn't passed it.
+        #
+        zone = str(self.AD.tz)
+        cached = self.dst_transitions.get(zone)
+        if cached is not None:
+            valid_from, transition = cached
+            if valid_from <= base and (transition is None or base < transition):
+                return transition
+
+        if hasattr(self.AD.tz, "_utc_transition_times"):
+            transition = self.find_dst_transition_pytz(base)
+        else:
+            transition = self.find_dst_transition_search(base)
+
+        self.dst_transitions[zone] = (base, transition)
+        return transition
+
+    def find_dst_transition_pytz(self, base):
+        #
+        # pytz already holds a sorted table of every UTC transition for the zone, so just look it up
+        #
+        tz = self.AD.tz
+        current = base.astimezone(tz).dst()
+        naive_base = base.astimezone(pytz.utc).replace(tzinfo=None)
+        index = bisect.bisect_right(tz._utc_transition_times, naive_base)
+        for i in range(index, len(tz._utc_transition_times)):
+            if tz._transition_info[i][1] != current:
+                return pytz.utc.localize(tz._utc_transition_times[i])
+        return None
+
+    def find_dst_transition_search(self, base, horizon_days=400):
+        #
+        # For timezones without a transition table, step forward a day at a time to bracket the change,
+        # then bisect down to the second. Transitions are always more than a day apart.
+        #
+        tz = self.AD.tz
+        current = base.astimezone(tz).dst()
+        lo = base
+        for _ in range(horizon_days):
+            hi = lo + timedelta(days=1)
+            if hi.astimezone(tz).dst() != current:
+                while (hi - lo).total_seconds() > 1:
+                    mid = lo + (hi - lo) / 2
+                    if mid.astimezone(tz).dst() == current:
+                        lo = mid
+                    else:
+                        hi = mid
+                return hi
+            lo = hi
+        return None
 
     async def loop(self):  # noqa: C901
         self.active = True
@@ -572,33 +696,20 @@ class Scheduler:
                     #
                     self.logger.info("Daylight Savings Time transition detected - rewriting events to new local time")
                     await self.process_dst(old_dst_offset, dst_offset)
-                    #
-                    # Re calculate next entries
-                    #
-                    next_entries = self.get_next_entries()
-
-                elif self.timer_resetted is True:
-                    # a timer was resetted, so need to recalculate next entries
-                    next_entries = self.get_next_entries()
-                    self.timer_resetted = False
 
                 old_dst_offset = dst_offset
                 #
                 # OK, lets fire the entries
                 #
-                for entry in next_entries:
-                    # Check timestamps as we might have been interrupted to add a callback
-                    if entry["timestamp"] <= self.now:
-                        name = entry["name"]
-                        uuid_ = entry["uuid"]
-                        # Things may have changed since we last woke up
-                        # so check our callbacks are still valid before we execute them
-                        if name in self.schedule and uuid_ in self.schedule[name]:
-                            args = self.schedule[name][uuid_]
-                            self.logger.debug("Executing: %s", args)
-                            await self.exec_schedule(name, args, uuid_)
-                    else:
-                        break
+                for entry in self.pop_due_entries():
+                    name = entry["name"]
+                    uuid_ = entry["uuid"]
+                    # Things may have changed while earlier entries were executing
+                    # so check our callbacks are still valid and haven't been rescheduled before we execute them
+                    if name in self.schedule and uuid_ in self.schedule[name] and uuid_ not in self.queued_timers:
+                        args = self.schedule[name][uuid_]
+                        self.logger.debug("Executing: %s", args)
+                        await self.exec_schedule(name, args, uuid_)
                 for k, v in list(self.schedule.items()):
                     if v == {}:
                         del self.schedule[k]
@@ -931,7 +1042,7 @@ class Scheduler:
         kwargs_copy = kwargs.copy()
         return utils._sanitize_kwargs(
             kwargs_copy,
-            ["interval", "constrain_days", "constrain_input_boolean", "_pin_app", "_pin_thread", "__silent"]
+            ["interval", "constrain_days", "constrain_input_boolean", "_pin_app", "_pin_thread", "__silent", "priority"]
             + app.list_constraints(),
         )
 
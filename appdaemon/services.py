@@ -1,6 +1,7 @@
 import threading
 import traceback
 import asyncio
+import functools
 from copy import deepcopy
 from typing import Any, Optional, Callable, Awaitable
 
@@ -8,6 +9,9 @@ from appdaemon.appdaemon import AppDaemon
 from appdaemon.exceptions import NamespaceException, DomainException, ServiceException
 import appdaemon.utils as utils
 
+# Entity ids that select entities without naming them, and are only accepted on their own rather than in a list
+UNBATCHABLE_ENTITY_IDS = frozenset(("all", "none"))
+
 
 class Services:
     def __init__(self, ad: AppDaemon):
@@ -16,6 +20,10 @@ class Services:
         self.services = {}
         self.services_lock = threading.RLock()
         self.app_registered_services = {}
+
+        # Calls waiting to be merged into a single call, see add_to_batch()
+        self.service_batches = {}
+
         self.logger = ad.logging.get_child("_services")
 
     def register_service(
@@ -202,7 +210,10 @@ class Services:
                     # We do what the kwarg tells us
                     isasync = self.services[namespace][domain][service]["__async"]
 
-            if isasync is True:
+            if self.can_batch(self.services[namespace][domain][service], data):
+                # Merged with other calls to the same service made within the batch window
+                coro = asyncio.shield(self.add_to_batch(namespace, ns, domain, service, data, funcref, isasync))
+            elif isasync is True:
                 # it's a coroutine just await it.
                 coro = funcref(ns, domain, service, data)
             else:
@@ -220,6 +231,79 @@ class Services:
             else:
                 asyncio.create_task(self.run_service(coro))
 
+    #
+    # Batching
+    #
+    # Calls to a service that accepts a list of entity_ids (registered with __batch=True) that only differ in their
+    # entity_id are collected for service_batch_window seconds, then made as a single call for all of the entities.
+    # Every caller gets the result of that call.
+    #
+
+    def can_batch(self, service_entry: dict, data: dict) -> bool:
+        if self.AD.service_batch_window <= 0 or service_entry.get("__batch") is not True:
+            return False
+
+        entity_ids = data.get("entity_id")
+        if isinstance(entity_ids, str):
+            entity_ids = [entity_ids]
+        elif not isinstance(entity_ids, list) or not entity_ids:
+            return False
+
+        # Merged with other ids, these would make the whole call fail
+        return all(
+            isinstance(entity_id, str) and entity_id.lower() not in UNBATCHABLE_ENTITY_IDS for entity_id in entity_ids
+        )
+
+    def add_to_batch(
+        self, namespace: str, ns: str, domain: str, service: str, data: dict, funcref: Callable, isasync: bool
+    ) -> asyncio.Future:
+        other_data = {key: value for key, value in data.items() if key != "entity_id"}
+        batch_key = (namespace, ns, domain, service, utils.convert_json(other_data, sort_keys=True))
+
+        batch = self.service_batches.get(batch_key)
+        if batch is None:
+            batch = {"entity_ids": {}, "data": other_data, "future": self.AD.loop.create_future()}
+            self.service_batches[batch_key] = batch
+            self.AD.loop.call_later(self.AD.service_batch_window, self.run_batch, batch_key, funcref, isasync)
+
+        entity_ids = data["entity_id"]
+        if isinstance(entity_ids, str):
+            entity_ids = [entity_ids]
+
+        # Entity ids are dict keys, so repeated calls for the same entity are only made once
+        for entity_id in entity_ids:
+            batch["entity_ids"][entity_id] = None
+
+        return batch["future"]
+
+    def run_batch(self, batch_key: tuple, funcref: Callable, isasync: bool) -> None:
+        batch = self.service_batches.pop(batch_key)
+        namespace, ns, domain, service, _ = batch_key
+
+        data = dict(batch["data"])
+        entity_ids = list(batch["entity_ids"])
+        data["entity_id"] = entity_ids[0] if len(entity_ids) == 1 else entity_ids
+
+        self.logger.debug("Calling batched service %s/%s/%s for %s", ns, domain, service, entity_ids)
+
+        if isasync is True:
+            coro = funcref(ns, domain, service, data)
+        else:
+            coro = utils.run_in_executor(self, funcref, ns, domain, service, data)
+
+        task = asyncio.create_task(self.run_service(coro))
+        task.add_done_callback(functools.partial(self.complete_batch, batch["future"]))
+
+    @staticmethod
+    def complete_batch(future: asyncio.Future, task: asyncio.Task) -> None:
+        if future.done():
+            return
+        if task.cancelled():
+            future.cancel()
+        else:
+            # run_service() never raises
+            future.set_result(task.result())
+
     async def run_service(self, coro: Awaitable) -> Any:
         """Used to process a service call"""
         try:
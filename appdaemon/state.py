@@ -3,6 +3,7 @@ import traceback
 import os
 from copy import copy, deepcopy
 import datetime
+import functools
 
 import appdaemon.utils as utils
 from appdaemon.appdaemon import AppDaemon
@@ -14,6 +15,13 @@ class State:
         self.AD = ad
 
         self.state = {"default": {}, "admin": {}, "rules": {}}
+
+        #
+        # Per namespace domain -> entity_ids index, so domain queries don't have to scan the whole namespace.
+        # Entity ids are stored as dict keys to keep insertion order.
+        #
+        self.domain_index = {"default": {}, "admin": {}, "rules": {}}
+
         self.logger = ad.logging.get_child("_state")
         self.app_added_namespaces = []
 
@@ -41,6 +49,7 @@ class State:
         else:
             nspath_file = None
             self.state[namespace] = {}
+            self.domain_index[namespace] = {}
 
         self.app_added_namespaces.append(namespace)
 
@@ -67,6 +76,10 @@ class State:
         result = None
         if namespace in self.app_added_namespaces:
             result = self.state.pop(namespace)
+            self.domain_index.pop(namespace, None)
+            if isinstance(result, utils.BatchedPersistentDict):
+                # Its contents stay available in memory
+                await utils.run_in_executor(self, result.close)
             nspath_file = await utils.run_in_executor(self, self.remove_persistent_namespace, namespace)
             self.app_added_namespaces.remove(namespace)
 
@@ -93,15 +106,54 @@ class State:
         """Used to add a database file for a created namespace"""
 
         try:
-            if namespace in self.state and isinstance(self.state[namespace], utils.PersistentDict):
+            if namespace in self.state and self.is_persistent(namespace):
                 self.logger.info("Persistent Namespace '%s' already initialized", namespace)
                 return
 
-            nspath = os.path.join(self.AD.config_dir, "namespaces")
-            safe = bool(writeback == "safe")
-            nspath_file = os.path.join(nspath, f"{namespace}.db")
-
-            self.state[namespace] = utils.PersistentDict(nspath_file, safe)
+            options = self.AD.namespaces.get(namespace, {})
+            storage = options.get("storage", "shelve")
+            if storage not in ("shelve", "sqlite"):
+                self.logger.warning("Unknown storage '%s' for namespace '%s', using shelve", storage, namespace)
+                storage = "shelve"
+
+            nspath_file = self.get_namespace_file(namespace, storage)
+
+            if storage == "sqlite":
+                #
+                # SQLite namespaces are written in batches from the executor, the writeback mode decides how soon
+                # changes are flushed. Safe namespaces are written straight away, before set_state() returns
+                #
+                safe = writeback == "safe"
+                if writeback == "batch":
+                    flush_interval = options.get("flush_interval", 1)
+                    flush_size = options.get("flush_size", 100)
+                elif writeback == "performance":
+                    flush_interval = flush_size = float("inf")
+                elif writeback == "hybrid":
+                    flush_interval, flush_size = 0, 100
+                else:
+                    flush_interval, flush_size = 0, float("inf")
+
+                self.state[namespace] = utils.SQLitePersistentDict(
+                    nspath_file,
+                    flush_interval=flush_interval,
+                    flush_size=flush_size,
+                    fsync=options.get("fsync", False),
+                    on_flush_size=functools.partial(self.request_flush, namespace),
+                    safe=safe,
+                )
+            elif writeback == "batch":
+                self.state[namespace] = utils.BatchedPersistentDict(
+                    nspath_file,
+                    flush_interval=options.get("flush_interval", 1),
+                    flush_size=options.get("flush_size", 100),
+                    fsync=options.get("fsync", False),
+                    on_flush_size=functools.partial(self.request_flush, namespace),
+                )
+            else:
+                safe = bool(writeback == "safe")
+                self.state[namespace] = utils.PersistentDict(nspath_file, safe)
+            self.rebuild_domain_index(namespace)
 
             self.logger.info("Persistent Namespace '%s' initialized", namespace)
 
@@ -118,12 +170,17 @@ class State:
         """Used to remove the file for a created namespace"""
 
         try:
-            nspath = os.path.join(self.AD.config_dir, "namespaces")
-            database_file = f"{namespace}.db"
-            nspath_file = os.path.join(nspath, database_file)
-
-            if os.path.isfile(nspath_file) is True:  # if the file exists remove it
-                os.remove(nspath_file)
+            storage = self.AD.namespaces.get(namespace, {}).get("storage", "shelve")
+            nspath_file = self.get_namespace_file(namespace, storage)
+
+            for database_file in (
+                self.get_namespace_file(namespace, "shelve"),
+                self.get_namespace_file(namespace, "sqlite"),
+                self.get_namespace_file(namespace, "sqlite") + "-wal",
+                self.get_namespace_file(namespace, "sqlite") + "-shm",
+            ):
+                if os.path.isfile(database_file) is True:  # if the file exists remove it
+                    os.remove(database_file)
 
         except Exception:
             self.logger.warning("-" * 60)
@@ -134,6 +191,12 @@ class State:
 
         return nspath_file
 
+    def get_namespace_file(self, namespace, storage):
+        nspath = os.path.join(self.AD.config_dir, "namespaces")
+        if storage == "sqlite":
+            return os.path.join(nspath, f"{namespace}.sqlite")
+        return os.path.join(nspath, f"{namespace}.db")
+
     async def list_namespaces(self):
         ns = []
         for namespace in self.state:
@@ -153,6 +216,10 @@ class State:
         self.logger.debug("terminate() called for state")
         self.logger.info("Saving all namespaces")
         self.save_all_namespaces()
+        for store in self.state.values():
+            if isinstance(store, utils.BatchedPersistentDict):
+                # Written by the final flush above
+                store.close()
 
     async def add_state_callback(self, name, namespace, entity, cb, kwargs):  # noqa: C901
         if self.AD.threading.validate_pin(name, kwargs) is True:
@@ -172,21 +239,22 @@ class State:
             #
 
             async with self.AD.callbacks.callbacks_lock:
-                if name not in self.AD.callbacks.callbacks:
-                    self.AD.callbacks.callbacks[name] = {}
-
                 handle = uuid.uuid4().hex
-                self.AD.callbacks.callbacks[name][handle] = {
-                    "name": name,
-                    "id": self.AD.app_management.objects[name]["id"],
-                    "type": "state",
-                    "function": cb,
-                    "entity": entity,
-                    "namespace": namespace,
-                    "pin_app": pin_app,
-                    "pin_thread": pin_thread,
-                    "kwargs": kwargs,
-                }
+                self.AD.callbacks.add_callback(
+                    name,
+                    handle,
+                    {
+                        "name": name,
+                        "id": self.AD.app_management.objects[name]["id"],
+                        "type": "state",
+                        "function": cb,
+                        "entity": entity,
+                        "namespace": namespace,
+                        "pin_app": pin_app,
+                        "pin_thread": pin_thread,
+                        "kwargs": kwargs,
+                    },
+                )
 
             #
             # If we have a timeout parameter, add a scheduler entry to delete the callback later
@@ -286,7 +354,7 @@ class State:
         async with self.AD.callbacks.callbacks_lock:
 
             if name in self.AD.callbacks.callbacks and handle in self.AD.callbacks.callbacks[name]:
-                del self.AD.callbacks.callbacks[name][handle]
+                self.AD.callbacks.remove_callback(name, handle)
                 await self.AD.state.remove_entity("admin", "state_callback.{}".format(handle))
                 executed = True
 
@@ -317,88 +385,47 @@ class State:
         data = state["data"]
         entity_id = data["entity_id"]
         self.logger.debug(data)
-        device, entity = entity_id.split(".")
 
         # Process state callbacks
 
         removes = []
         async with self.AD.callbacks.callbacks_lock:
-            for name in self.AD.callbacks.callbacks.keys():
-                for uuid_ in self.AD.callbacks.callbacks[name]:
-                    callback = self.AD.callbacks.callbacks[name][uuid_]
-                    if callback["type"] == "state" and (
-                        callback["namespace"] == namespace or callback["namespace"] == "global" or namespace == "global"
-                    ):
-                        cdevice = None
-                        centity = None
-                        if callback["entity"] is not None:
-                            if "." not in callback["entity"]:
-                                cdevice = callback["entity"]
-                                centity = None
-                            else:
-                                cdevice, centity = callback["entity"].split(".")
-                        if callback["kwargs"].get("attribute") is None:
-                            cattribute = "state"
-                        else:
-                            cattribute = callback["kwargs"].get("attribute")
-
-                        cold = callback["kwargs"].get("old")
-                        cnew = callback["kwargs"].get("new")
-
-                        executed = False
-                        if cdevice is None:
-                            executed = await self.AD.threading.check_and_dispatch_state(
-                                name,
-                                callback["function"],
-                                entity_id,
-                                cattribute,
-                                data["new_state"],
-                                data["old_state"],
-                                cold,
-                                cnew,
-                                callback["kwargs"],
-                                uuid_,
-                                callback["pin_app"],
-                                callback["pin_thread"],
-                            )
-                        elif centity is None:
-                            if device == cdevice:
-                                executed = await self.AD.threading.check_and_dispatch_state(
-                                    name,
-                                    callback["function"],
-                                    entity_id,
-                                    cattribute,
-                                    data["new_state"],
-                                    data["old_state"],
-                                    cold,
-                                    cnew,
-                                    callback["kwargs"],
-                                    uuid_,
-                                    callback["pin_app"],
-                                    callback["pin_thread"],
-                                )
-
-                        elif device == cdevice and entity == centity:
-                            executed = await self.AD.threading.check_and_dispatch_state(
-                                name,
-                                callback["function"],
-                                entity_id,
-                                cattribute,
-                                data["new_state"],
-                                data["old_state"],
-                                cold,
-                                cnew,
-                                callback["kwargs"],
-                                uuid_,
-                                callback["pin_app"],
-                                callback["pin_thread"],
-                            )
-
-                        # Remove the callback if appropriate
-                        if executed is True:
-                            remove = callback["kwargs"].get("oneshot", False)
-                            if remove is True:
-                                removes.append({"name": callback["name"], "uuid": uuid_})
+            #
+            # Only visit the callbacks indexed against this entity, its domain or all entities
+            #
+            for name, uuid_ in self.AD.callbacks.get_state_callbacks(namespace, entity_id):
+                callback = self.AD.callbacks.callbacks[name][uuid_]
+
+                if callback["kwargs"].get("attribute") is None:
+                    cattribute = "state"
+                else:
+                    cattribute = callback["kwargs"].get("attribute")
+
+                cold = callback["kwargs"].get("old")
+                cnew = callback["kwargs"].get("new")
+
+                executed = await self.AD.threading.check_and_dispatch_state(
+                    name,
+                    callback["function"],
+                    entity_id,
+                    cattribute,
+                    data["new_state"],
+                    data["old_state"],
+                    cold,
+                    cnew,
+                    callback["kwargs"],
+                    uuid_,
+                    callback["pin_app"],
+                    callback["pin_thread"],
+                    callback.get("rate_limit"),
+                    callback.get("constraints"),
+                )
+
+                # Remove the callback if appropriate
+                if executed is True:
+                    remove = callback["kwargs"].get("oneshot", False)
+                    if remove is True:
+                        removes.append({"name": callback["name"], "uuid": uuid_})
 
         for remove in removes:
             await self.cancel_state_callback(remove["uuid"], remove["name"])
@@ -410,19 +437,22 @@ class State:
             return False
 
     def get_entity(self, namespace=None, entity_id=None, name=None):
+        #
+        # State records are never modified in place, so a shallow snapshot is consistent and safe to serialize
+        #
         if namespace is None:
-            return deepcopy(self.state)
+            return {ns: self.snapshot_namespace(ns) for ns in self.state}
 
         if entity_id is None:
             if namespace in self.state:
-                return deepcopy(self.state[namespace])
+                return self.snapshot_namespace(namespace)
             else:
                 self.logger.warning("Unknown namespace: %s requested by %s", namespace, name)
                 return None
 
         if namespace in self.state:
             if entity_id in self.state[namespace]:
-                return deepcopy(self.state[namespace][entity_id])
+                return self.state[namespace][entity_id]
             else:
                 self.logger.warning("Unknown entity: %s requested by %s", entity_id, name)
                 return None
@@ -460,6 +490,7 @@ class State:
 
         if entity_id in self.state[namespace]:
             self.state[namespace].pop(entity_id)
+            self.unindex_entity(namespace, entity_id)
             data = {"event_type": "__AD_ENTITY_REMOVED", "data": {"entity_id": entity_id}}
             self.AD.loop.create_task(self.AD.events.process_event(namespace, data))
 
@@ -471,14 +502,17 @@ class State:
         if isinstance(attributes, dict):
             attrs.update(attributes)
 
-        state = {
-            "entity_id": entity,
-            "state": state,
-            "last_changed": utils.dt_to_str(datetime.datetime(1970, 1, 1, 0, 0, 0, 0)),
-            "attributes": attrs,
-        }
+        state = utils.freeze(
+            {
+                "entity_id": entity,
+                "state": state,
+                "last_changed": utils.dt_to_str(datetime.datetime(1970, 1, 1, 0, 0, 0, 0)),
+                "attributes": attrs,
+            }
+        )
 
         self.state[namespace][entity] = state
+        self.index_entity(namespace, entity)
 
         data = {
             "event_type": "__AD_ENTITY_ADDED",
@@ -510,20 +544,54 @@ class State:
             raise ValueError("{}: Querying a specific attribute is only possible for a single entity".format(name))
 
         if entity_id is None:
-            return maybe_copy(self.state[namespace])
+            if copy:
+                return deepcopy(self.state[namespace])
+            return self.snapshot_namespace(namespace)
+
+        entities = self.state[namespace]
+        domain_entities = self.domain_index[namespace].get(entity_id, ())
+        return {entity: maybe_copy(entities[entity]) for entity in domain_entities if entity in entities}
+
+    #
+    # Domain index
+    #
 
+    def index_entity(self, namespace, entity_id):
         domain = entity_id.split(".", 1)[0]
-        return {
-            entity_id: maybe_copy(state)
-            for entity_id, state in self.state[namespace].items()
-            if entity_id.split(".", 1)[0] == domain
-        }
+        self.domain_index.setdefault(namespace, {}).setdefault(domain, {})[entity_id] = None
+
+    def unindex_entity(self, namespace, entity_id):
+        domain = entity_id.split(".", 1)[0]
+        entities = self.domain_index.get(namespace, {}).get(domain)
+        if entities is not None:
+            entities.pop(entity_id, None)
+            if not entities:
+                del self.domain_index[namespace][domain]
+
+    def rebuild_domain_index(self, namespace):
+        self.domain_index[namespace] = {}
+        for entity_id in self.state[namespace]:
+            self.index_entity(namespace, entity_id)
+
+    def snapshot_namespace(self, namespace):
+        #
+        # A point in time view of a namespace that doesn't change as later events arrive.
+        # Records are shared with the live namespace, so callers must treat them as read only.
+        #
+        return dict(self.state[namespace])
 
     def parse_state(self, entity, namespace, **kwargs):
+        #
+        # Build a new state record from the current one and kwargs.
+        # Stored records are never modified in place (copy on write) - a change always replaces the whole record,
+        # so anyone holding a reference to an old record, such as a callback's old_state, sees a consistent snapshot.
+        # Records are frozen when they are stored, so that they can be handed to callbacks as they are.
+        #
         self.logger.debug("parse_state: %s, %s", entity, kwargs)
 
         if entity in self.state[namespace]:
-            new_state = self.state[namespace][entity]
+            new_state = dict(self.state[namespace][entity])
+            new_state["attributes"] = dict(new_state.get("attributes", {}))
         else:
             # Its a new state entry
             new_state = {"attributes": {}}
@@ -534,7 +602,7 @@ class State:
 
         if "attributes" in kwargs:
             if kwargs.get("replace", False):
-                new_state["attributes"] = kwargs["attributes"]
+                new_state["attributes"] = dict(kwargs["attributes"])
             else:
                 new_state["attributes"].update(kwargs["attributes"])
         else:
@@ -552,17 +620,17 @@ class State:
             await self.set_state(name, namespace, entity_id, state=value)
 
     async def add_to_attr(self, name, namespace, entity_id, attr, i):
-        state = await self.get_state(name, namespace, entity_id, attribute="all")
+        state = await self.get_state(name, namespace, entity_id, attribute="all", copy=False)
         if state is not None:
-            state["attributes"][attr] = copy(state["attributes"][attr]) + i
-            await self.set_state(name, namespace, entity_id, attributes=state["attributes"])
+            await self.set_state(name, namespace, entity_id, attributes={attr: copy(state["attributes"][attr]) + i})
 
     def set_state_simple(self, namespace, entity_id, state):
         #
         # Set state without any checks or triggering amy evernts, and only if the entity exists
         #
         if namespace in self.state and entity_id in self.state[namespace]:
-            self.state[namespace][entity_id] = state
+            # The entity already exists, so the domain index doesn't change
+            self.state[namespace][entity_id] = utils.freeze(state)
 
     async def state_services(self, namespace, domain, service, kwargs):
         self.logger.debug("state_services: %s, %s, %s, %s", namespace, domain, service, kwargs)
@@ -610,15 +678,18 @@ class State:
 
     async def set_state(self, name, namespace, entity, **kwargs):
         self.logger.debug("set_state(): %s, %s", entity, kwargs)
-        if entity in self.state[namespace]:
-            old_state = deepcopy(self.state[namespace][entity])
+        exists = entity in self.state[namespace]
+        if exists:
+            # No need to copy, parse_state() never modifies the stored record
+            old_state = self.state[namespace][entity]
         else:
             old_state = {"state": None, "attributes": {}}
         new_state = self.parse_state(entity, namespace, **kwargs)
         new_state["last_changed"] = utils.dt_to_str((await self.AD.sched.get_now()).replace(microsecond=0), self.AD.tz)
+        new_state = utils.freeze(new_state)
         self.logger.debug("Old state: %s", old_state)
         self.logger.debug("New state: %s", new_state)
-        if not await self.AD.state.entity_exists(namespace, entity):
+        if not exists:
             if not ("_silent" in kwargs and kwargs["_silent"] is True):
                 self.logger.info("%s: Entity %s created in namespace: %s", name, entity, namespace)
 
@@ -630,16 +701,24 @@ class State:
             # We assume that the state change will come back to us via the plugin
             self.logger.debug("sending event to plugin")
 
+            # Reflect the change locally in the meantime if we already know about the entity
+            if exists:
+                self.state[namespace][entity] = new_state
+
             result = await plugin.set_plugin_state(
                 namespace, entity, state=new_state["state"], attributes=new_state["attributes"]
             )
             if result is not None:
                 if "entity_id" in result:
                     result.pop("entity_id")
-                self.state[namespace][entity] = self.parse_state(entity, namespace, **result)
+                self.state[namespace][entity] = utils.freeze(self.parse_state(entity, namespace, **result))
+                # The entity may have come or gone while we waited on the plugin
+                self.index_entity(namespace, entity)
         else:
             # Set the state locally
             self.state[namespace][entity] = new_state
+            if not exists:
+                self.index_entity(namespace, entity)
             # Fire the event locally
             self.logger.debug("sending event locally")
             data = {
@@ -656,6 +735,7 @@ class State:
         return new_state
 
     def set_namespace_state(self, namespace, state, persist=False):
+        state = {entity_id: utils.freeze(record) for entity_id, record in state.items()}
         if persist is True:
             self.add_persistent_namespace(namespace, "safe")
             self.state[namespace].update(state)
@@ -664,16 +744,67 @@ class State:
             self.remove_persistent_namespace(namespace)
             self.state[namespace] = state
 
+        self.rebuild_domain_index(namespace)
+
     def update_namespace_state(self, namespace, state):
+        #
+        # Merge a refreshed copy of the namespace(s), only writing the entities that changed.
+        # Returns the changes as (namespace, entity_id, old_state, new_state) tuples
+        #
+        changes = []
         if isinstance(namespace, list):  # if its a list, meaning multiple namespaces to be updated
             for ns in namespace:
                 if state.get(ns) is not None:
-                    self.state[ns].update(state[ns])
+                    changes.extend(self.merge_namespace_state(ns, state[ns]))
         else:
-            self.state[namespace].update(state)
+            changes.extend(self.merge_namespace_state(namespace, state))
+
+        return changes
+
+    def merge_namespace_state(self, namespace, state):
+        entities = self.state[namespace]
+        changes = []
+        for entity_id, new_state in state.items():
+            old_state = entities.get(entity_id)
+            if old_state is not None and not self.is_newer_state(old_state, new_state):
+                continue
+
+            new_state = utils.freeze(new_state)
+            entities[entity_id] = new_state
+            if old_state is None:
+                self.index_entity(namespace, entity_id)
+            changes.append((namespace, entity_id, old_state, new_state))
+
+        return changes
+
+    @staticmethod
+    def is_newer_state(old_state, new_state):
+        #
+        # A refreshed record can be older than events applied while the refresh was being fetched, and taking it
+        # would put the entity back to a stale state. When the records are timestamped, only a newer one is taken
+        #
+        if isinstance(old_state, dict) and isinstance(new_state, dict):
+            # HA moves last_updated on any change to the state or its attributes
+            for key in ("last_updated", "last_changed"):
+                old_time = old_state.get(key)
+                new_time = new_state.get(key)
+                if old_time is None or new_time is None:
+                    continue
+                if old_time == new_time:
+                    return False
+                try:
+                    return utils.str_to_dt(new_time) > utils.str_to_dt(old_time)
+                except (TypeError, ValueError, OverflowError):
+                    break
+        return old_state != new_state
+
+    def is_persistent(self, namespace):
+        return isinstance(self.state[namespace], (utils.PersistentDict, utils.BatchedPersistentDict))
 
     async def save_namespace(self, namespace):
-        if isinstance(self.state[namespace], utils.PersistentDict):
+        if isinstance(self.state[namespace], utils.BatchedPersistentDict):
+            await self.flush_namespace(namespace)
+        elif isinstance(self.state[namespace], utils.PersistentDict):
             self.state[namespace].sync()
         else:
             self.logger.warning("Namespace: %s cannot be saved", namespace)
@@ -681,14 +812,42 @@ class State:
 
     def save_all_namespaces(self):
         for ns in self.state:
-            if isinstance(self.state[ns], utils.PersistentDict):
+            if self.is_persistent(ns):
                 self.state[ns].sync()
 
     def save_hybrid_namespaces(self):
         for ns in self.AD.namespaces:
-            if self.AD.namespaces[ns].get("writeback") == "hybrid":
+            # Batched namespaces are flushed from the executor by save_batched_namespaces()
+            if self.AD.namespaces[ns].get("writeback") == "hybrid" and isinstance(self.state[ns], utils.PersistentDict):
                 self.state[ns].sync()
 
+    #
+    # Batched namespaces are flushed from the executor so that disk writes never block the loop
+    #
+
+    def request_flush(self, namespace):
+        # May be called from any thread once a batch is full
+        self.AD.loop.call_soon_threadsafe(self.AD.loop.create_task, self.flush_namespace(namespace))
+
+    async def flush_namespace(self, namespace):
+        store = self.state.get(namespace)
+        if not isinstance(store, utils.BatchedPersistentDict):
+            return
+        try:
+            count = await utils.run_in_executor(self, store.flush)
+            self.logger.debug("Flushed %s entities in namespace %s", count, namespace)
+        except Exception:
+            self.logger.warning("-" * 60)
+            self.logger.warning("Unexpected error saving namespace %s", namespace)
+            self.logger.warning("-" * 60)
+            self.logger.warning(traceback.format_exc())
+            self.logger.warning("-" * 60)
+
+    async def save_batched_namespaces(self):
+        for ns, store in list(self.state.items()):
+            if isinstance(store, utils.BatchedPersistentDict) and store.flush_due():
+                await self.flush_namespace(ns)
+
     #
     # Utilities
     #
@@ -712,6 +871,10 @@ class State:
                 "pin_thread",
                 "__delay",
                 "__silent",
+                "throttle",
+                "debounce",
+                "max_rate",
+                "priority",
             ]
             + app.list_constraints(),
         )
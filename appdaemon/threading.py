@@ -1,20 +1,234 @@
 import asyncio
 import threading
 import datetime
-from queue import Queue
+import heapq
+import itertools
+from collections import deque
 from random import randint
 import re
 import sys
+import time
 import traceback
 import inspect
 from datetime import timedelta
 import logging
-import iso8601
 
 from appdaemon import utils as utils
 from appdaemon.appdaemon import AppDaemon
 
 
+class Constraints:
+    """The constraints of an app or callback, compiled once from its config or kwargs.
+
+    ``is_current()`` tells whether they still match the app, the args and the constraints the app has registered,
+    so that they can be recompiled when any of these change. The start and end times of a time constraint are
+    parsed once a day, as they may be relative to sunrise or sunset.
+    """
+
+    def __init__(self, app, args, logger=None, name=None):
+        self.app = app
+        self.args = args
+
+        list_constraints = getattr(app, "list_constraints", None)
+        self.names = tuple(list_constraints()) if list_constraints is not None else ()
+        self.custom = [(getattr(app, key), value) for key, value in args.items() if key in self.names]
+
+        self.start_time = None
+        self.end_time = None
+        if "constrain_start_time" in args or "constrain_end_time" in args:
+            self.start_time = args.get("constrain_start_time", "00:00:00")
+            self.end_time = args.get("constrain_end_time", "23:59:59")
+        self.window_date = None
+        self.window = None
+
+        self.days = None
+        if "constrain_days" in args:
+            try:
+                self.days = {utils.day_of_week(day) for day in args["constrain_days"].split(",")}
+            except (KeyError, AttributeError):
+                if logger is not None:
+                    logger.warning("Invalid constrain_days for %s: %s", name, args["constrain_days"])
+                # Never run, as before when the days failed to parse at dispatch
+                self.days = set()
+
+        self.empty = not self.custom and self.start_time is None and self.days is None and "constrain_state" not in args
+
+    def is_current(self, app, args):
+        if app is not self.app or args is not self.args:
+            return False
+        list_constraints = getattr(app, "list_constraints", None)
+        return (tuple(list_constraints()) if list_constraints is not None else ()) == self.names
+
+
+class Lane:
+    """Mailbox of a lane app's callbacks, run in order and one at a time by whichever thread is free."""
+
+    def __init__(self, name):
+        self.name = name
+        # (priority, args) of each callback, in the order they were queued
+        self.mailbox = deque()
+        # True while the lane is in the shared queue or one of its callbacks is running
+        self.scheduled = False
+
+
+class RunQueue:
+    """Run queue of the worker threads.
+
+    Each thread keeps a queue of its own for the callbacks pinned to it, which it always serves first. Threads
+    that aren't reserved for pinned apps then take the next entry from the shared queue, so an unpinned callback
+    only waits while all of those threads are busy. The shared queue holds unpinned callbacks when
+    ``load_distribution`` is ``shared``, and the lanes of lane apps that have callbacks waiting. A lane is only
+    in the shared queue while none of its callbacks is running, and goes back into it after each callback, with
+    the priority of its next callback.
+
+    All queues are served in order of priority, highest first, and then in the order the callbacks were queued.
+    With ``aging``, a callback gains one priority level for every ``aging`` seconds it has waited, so that a
+    steady stream of higher priority callbacks can't hold up the others for ever. As all waiting callbacks age at
+    the same rate, this is the same as ordering them by their priority less the time they were queued divided by
+    ``aging``, which doesn't change while they wait.
+    """
+
+    def __init__(self, pin_threads, aging=0):
+        self.lock = threading.Lock()
+        # Heap of (key, time queued, entry)
+        self.shared = []
+        self.lanes = {}
+        # Number of callbacks waiting in the shared queue and the lanes
+        self.size = 0
+        # Threads waiting for unpinned callbacks
+        self.waiting = deque()
+        # Returns the number of threads reserved for pinned apps
+        self.pin_threads = pin_threads
+        self.aging = aging
+        self.sequence = itertools.count()
+
+    def get_q(self, thread_id):
+        return ThreadQueue(self, thread_id)
+
+    def key(self, priority, now):
+        # Must be called with the lock held
+        if self.aging:
+            return now / self.aging - priority, next(self.sequence)
+        return -priority, next(self.sequence)
+
+    def put(self, args, priority=0):
+        with self.lock:
+            self.size += 1
+            self.schedule(args, priority)
+
+    def put_lane(self, name, args, priority=0):
+        with self.lock:
+            lane = self.lanes.get(name)
+            if lane is None:
+                lane = Lane(name)
+                self.lanes[name] = lane
+            lane.mailbox.append((priority, args))
+            self.size += 1
+            if not lane.scheduled:
+                lane.scheduled = True
+                self.schedule(lane, priority)
+
+    def schedule(self, entry, priority):
+        # Must be called with the lock held
+        now = time.monotonic()
+        heapq.heappush(self.shared, (self.key(priority, now), now, entry))
+        if self.waiting:
+            self.waiting.popleft().condition.notify()
+
+    def qsize(self):
+        return self.size
+
+    def oldest_wait(self):
+        # Seconds the oldest entry of the shared queue has been waiting for a thread
+        with self.lock:
+            if not self.shared:
+                return 0
+            return time.monotonic() - min(queued for _, queued, _ in self.shared)
+
+
+class ThreadQueue:
+    """A worker thread's view of the ``RunQueue``, with the ``Queue`` methods the workers use."""
+
+    def __init__(self, run_queue, thread_id):
+        self.run_queue = run_queue
+        self.number = int(thread_id.split("-")[1])
+        # Heap of (key, time queued, args)
+        self.pinned = []
+        self.condition = threading.Condition(run_queue.lock)
+        # Lane of the callback the thread is running, if any
+        self.lane = None
+
+    def put_nowait(self, args, priority=0):
+        with self.run_queue.lock:
+            now = time.monotonic()
+            heapq.heappush(self.pinned, (self.run_queue.key(priority, now), now, args))
+            self.condition.notify()
+
+    def get(self):
+        run_queue = self.run_queue
+        with run_queue.lock:
+            # In case the thread died before finishing its last callback
+            self.release_lane()
+
+            while True:
+                if self.pinned:
+                    _, _, args = heapq.heappop(self.pinned)
+                    if args is None and run_queue.shared and run_queue.waiting:
+                        # The thread is stopping, so pass on any shared entry it was woken up for
+                        run_queue.waiting.popleft().condition.notify()
+                    return args
+
+                unpinned = self.number >= run_queue.pin_threads()
+                if unpinned and run_queue.shared:
+                    _, _, entry = heapq.heappop(run_queue.shared)
+                    run_queue.size -= 1
+                    if isinstance(entry, Lane):
+                        self.lane = entry
+                        return entry.mailbox.popleft()[1]
+                    return entry
+
+                if unpinned:
+                    run_queue.waiting.append(self)
+                self.condition.wait()
+                if self in run_queue.waiting:
+                    run_queue.waiting.remove(self)
+
+    def qsize(self):
+        return len(self.pinned)
+
+    def oldest_wait(self):
+        # Seconds the oldest callback queued to the thread has been waiting for it
+        with self.run_queue.lock:
+            queued = [queued for _, queued, args in self.pinned if args is not None]
+            if not queued:
+                return 0
+            return time.monotonic() - min(queued)
+
+    def stop(self):
+        # The thread exits once it has run the callbacks already queued to it
+        with self.run_queue.lock:
+            now = time.monotonic()
+            heapq.heappush(self.pinned, ((float("inf"), next(self.run_queue.sequence)), now, None))
+            self.condition.notify()
+
+    def task_done(self):
+        with self.run_queue.lock:
+            self.release_lane()
+
+    def release_lane(self):
+        # Must be called with the lock held
+        lane = self.lane
+        if lane is None:
+            return
+
+        self.lane = None
+        if lane.mailbox:
+            # Behind the callbacks of the same priority, so that a busy app doesn't hold up the others
+            self.run_queue.schedule(lane, lane.mailbox[0][0])
+        else:
+            lane.scheduled = False
+
+
 class Threading:
     def __init__(self, ad: AppDaemon, kwargs):
 
@@ -48,6 +262,40 @@ class Threading:
         self.last_stats_time = datetime.datetime(1970, 1, 1, 0, 0, 0, 0)
         self.callback_list = []
 
+        #
+        # Thread and callback statistics are accumulated here by the workers without touching the event loop,
+        # then published to the admin namespace by flush_thread_info() every admin_delay seconds
+        #
+
+        self.stats_lock = threading.Lock()
+        self.stats_dirty = False
+        self.thread_activity = {}
+        self.dirty_threads = set()
+        self.app_activity = {}
+        self.pending_fired = {}
+        self.pending_executed = {}
+        self.pending_app_callbacks = {}
+        self.callbacks_total_fired = 0
+        self.callbacks_total_executed = 0
+        self.threads_current_busy = 0
+        self.threads_max_busy = 0
+        self.threads_max_busy_time = datetime.datetime(1970, 1, 1, 0, 0, 0, 0)
+        self.threads_last_action_time = datetime.datetime(1970, 1, 1, 0, 0, 0, 0)
+
+        # Compiled constraints from each app's config
+        self.app_constraints = {}
+
+        # Shared by the threads, for unpinned callbacks when load_distribution is shared and for lane apps
+        self.run_queue = None
+        self.lane_apps = False
+        self.priority_aging = 0
+
+        # Bounds and thresholds of the autoscaler, None unless thread_autoscaling is configured
+        self.autoscaling = None
+        self.last_scaled = None
+        self.threads_added = 0
+        self.threads_removed = 0
+
     async def get_q_update(self):
         for thread in self.threads:
             qsize = self.get_q(thread).qsize()
@@ -55,9 +303,12 @@ class Threading:
 
     async def get_callback_update(self):
         now = datetime.datetime.now()
-        self.callback_list.append(
-            {"fired": self.current_callbacks_fired, "executed": self.current_callbacks_executed, "ts": now}
-        )
+        with self.stats_lock:
+            self.callback_list.append(
+                {"fired": self.current_callbacks_fired, "executed": self.current_callbacks_executed, "ts": now}
+            )
+            self.current_callbacks_executed = 0
+            self.current_callbacks_fired = 0
 
         if len(self.callback_list) > 10:
             self.callback_list.pop(0)
@@ -88,8 +339,6 @@ class Threading:
         )
 
         self.last_stats_time = now
-        self.current_callbacks_executed = 0
-        self.current_callbacks_fired = 0
 
     async def init_admin_stats(self):
 
@@ -130,7 +379,11 @@ class Threading:
         self.pin_apps = True
         utils.process_arg(self, "pin_apps", kwargs)
 
-        if self.pin_apps is True:
+        self.lane_apps = False
+        utils.process_arg(self, "lane_apps", kwargs)
+
+        # Lane apps run on the threads that aren't reserved for pinned apps
+        if self.pin_apps is True and self.lane_apps is not True:
             self.pin_threads = self.total_threads
         else:
             self.auto_pin = False
@@ -146,6 +399,19 @@ class Threading:
         if self.pin_threads < 0:
             raise ValueError("pin_threads cannot be < 0")
 
+        utils.process_arg(self, "priority_aging", kwargs, float=True)
+
+        if self.priority_aging < 0:
+            raise ValueError("priority_aging cannot be < 0")
+
+        if "thread_autoscaling" in kwargs:
+            self.autoscaling = self.parse_autoscaling(kwargs["thread_autoscaling"])
+            if self.autoscaling is not None:
+                # Start within the bounds
+                unpinned = self.total_threads - self.pin_threads
+                unpinned = min(max(unpinned, self.autoscaling["min_threads"]), self.autoscaling["max_threads"])
+                self.total_threads = self.pin_threads + unpinned
+
         self.logger.info(
             "Starting Apps with %s workers and %s pins",
             self.total_threads,
@@ -154,6 +420,8 @@ class Threading:
 
         self.next_thread = self.pin_threads
 
+        self.run_queue = RunQueue(lambda: self.pin_threads, self.priority_aging)
+
         self.thread_count = 0
         for i in range(self.total_threads):
             await self.add_thread(True)
@@ -171,6 +439,23 @@ class Threading:
             },
         )
 
+        if self.autoscaling is not None:
+            await self.add_entity(
+                "admin",
+                "sensor.threads_autoscaler",
+                self.thread_count - self.pin_threads,
+                {
+                    "min_threads": self.autoscaling["min_threads"],
+                    "max_threads": self.autoscaling["max_threads"],
+                    "last_action": "none",
+                    "last_thread": None,
+                    "last_reason": None,
+                    "last_action_time": utils.dt_to_str(datetime.datetime(1970, 1, 1, 0, 0, 0, 0)),
+                    "threads_added": 0,
+                    "threads_removed": 0,
+                },
+            )
+
     def get_q(self, thread_id):
         return self.threads[thread_id]["queue"]
 
@@ -187,6 +472,7 @@ class Threading:
         qsize = 0
         for thread in self.threads:
             qsize += self.threads[thread]["queue"].qsize()
+        qsize += self.run_queue.qsize()
         return qsize
 
     def min_q_id(self):
@@ -201,6 +487,7 @@ class Threading:
         return id
 
     async def get_thread_info(self):
+        await self.flush_thread_info()
         info = {}
         info["max_busy_time"] = await self.get_state("_threading", "admin", "sensor.threads_max_busy_time")
         info["last_action_time"] = await self.get_state("_threading", "admin", "sensor.threads_last_action_time")
@@ -217,6 +504,7 @@ class Threading:
         return info
 
     async def dump_threads(self):
+        await self.flush_thread_info()
         self.diag.info("--------------------------------------------------")
         self.diag.info("Threads")
         self.diag.info("--------------------------------------------------")
@@ -255,6 +543,10 @@ class Threading:
         #   Load distribution
         #
 
+        priority = args["kwargs"].get("priority")
+        if priority is None:
+            priority = self.AD.app_management.objects.get(args["name"], {}).get("callback_priority", 0)
+
         # Check for pinned app and if so figure correct thread for app
 
         if args["pin_app"] is True:
@@ -270,7 +562,15 @@ class Threading:
         else:
             if self.thread_count == self.pin_threads:
                 raise ValueError("pin_threads must be set lower than threads if unpinned_apps are in use")
-            if self.AD.load_distribution == "load":
+            if self.app_is_lane(args["name"]):
+                # Runs after the app's earlier callbacks, on the first thread not reserved for pinned apps to be free
+                self.run_queue.put_lane(args["name"], args, priority)
+                return
+            elif self.AD.load_distribution == "shared":
+                # Any thread not reserved for pinned apps will take it as soon as it is free
+                self.run_queue.put(args, priority)
+                return
+            elif self.AD.load_distribution == "load":
                 thread = self.min_q_id()
             elif self.AD.load_distribution == "random":
                 thread = randint(self.pin_threads, self.thread_count - 1)
@@ -287,7 +587,7 @@ class Threading:
         id = "thread-{}".format(thread)
         q = self.threads[id]["queue"]
 
-        q.put_nowait(args)
+        q.put_nowait(args, priority)
 
     async def check_overdue_and_dead_threads(self):
         if self.AD.sched.realtime is True and self.AD.thread_duration_warning_threshold != 0:
@@ -298,15 +598,8 @@ class Threading:
                     self.logger.critical("Thread will be restarted")
                     id = thread_id.split("-")[1]
                     await self.add_thread(silent=False, pinthread=False, id=id)
-                if await self.get_state("_threading", "admin", "thread.{}".format(thread_id)) != "idle":
-                    start = utils.str_to_dt(
-                        await self.get_state(
-                            "_threading",
-                            "admin",
-                            "thread.{}".format(thread_id),
-                            attribute="time_called",
-                        )
-                    )
+                callback, start = self.get_thread_activity(thread_id)
+                if callback != "idle":
                     dur = (await self.AD.sched.get_now() - start).total_seconds()
                     if (
                         dur >= self.AD.thread_duration_warning_threshold
@@ -314,19 +607,12 @@ class Threading:
                     ):
                         self.logger.warning(
                             "Excessive time spent in callback: %s - %s",
-                            await self.get_state(
-                                "_threading",
-                                "admin",
-                                "thread.{}".format(thread_id),
-                                attribute="callback",
-                            ),
+                            callback,
                             dur,
                         )
 
     async def check_q_size(self, warning_step, warning_iterations):
-        totalqsize = 0
-        for thread in self.threads:
-            totalqsize += self.threads[thread]["queue"].qsize()
+        totalqsize = self.total_q_size()
 
         if totalqsize > self.AD.qsize_warning_threshold:
             if (
@@ -336,21 +622,18 @@ class Threading:
                 for thread in self.threads:
                     qsize = self.threads[thread]["queue"].qsize()
                     if qsize > 0:
+                        callback, time_called = self.get_thread_activity(thread)
                         self.logger.warning(
                             "Queue size for thread %s is %s, callback is '%s' called at %s - possible thread starvation",
                             thread,
                             qsize,
-                            await self.get_state("_threading", "admin", "thread.{}".format(thread)),
-                            iso8601.parse_date(
-                                await self.get_state(
-                                    "_threading",
-                                    "admin",
-                                    "thread.{}".format(thread),
-                                    attribute="time_called",
-                                )
-                            ),
+                            callback,
+                            time_called,
                         )
 
+                if self.run_queue.qsize() > 0:
+                    self.logger.warning("Shared queue size is %s - possible thread starvation", self.run_queue.qsize())
+
                 await self.dump_threads()
                 warning_step = 0
             warning_step += 1
@@ -363,7 +646,136 @@ class Threading:
 
         return warning_step, warning_iterations
 
-    async def update_thread_info(self, thread_id, callback, app, type, uuid, silent):
+    #
+    # Autoscaling
+    #
+
+    def parse_autoscaling(self, config):
+        if self.auto_pin is True:
+            self.logger.warning(
+                "thread_autoscaling only scales threads that aren't reserved for pinned apps - "
+                "set total_threads or turn off pin_apps to use it"
+            )
+            return None
+
+        if not isinstance(config, dict):
+            self.logger.warning("thread_autoscaling should be a dictionary, ignoring it")
+            return None
+
+        try:
+            min_threads = int(config.get("min_threads", self.total_threads - self.pin_threads))
+            autoscaling = {
+                "min_threads": min_threads,
+                "max_threads": int(config.get("max_threads", min_threads * 2)),
+                "queue_threshold": int(config.get("queue_threshold", 5)),
+                "wait_threshold": float(config.get("wait_threshold", 1)),
+                "cooldown": float(config.get("cooldown", 60)),
+            }
+        except (TypeError, ValueError):
+            self.logger.warning("Invalid value in thread_autoscaling, ignoring it")
+            return None
+
+        if autoscaling["min_threads"] < 1 or autoscaling["max_threads"] < autoscaling["min_threads"]:
+            self.logger.warning("thread_autoscaling needs 1 <= min_threads <= max_threads, ignoring it")
+            return None
+
+        return autoscaling
+
+    def unpinned_q_size(self):
+        # Callbacks waiting for threads that aren't reserved for pinned apps
+        qsize = self.run_queue.qsize()
+        for thread in self.threads:
+            if int(thread.split("-")[1]) >= self.pin_threads:
+                qsize += self.threads[thread]["queue"].qsize()
+        return qsize
+
+    def unpinned_oldest_wait(self):
+        # Seconds the oldest callback waiting for a thread that isn't reserved for pinned apps has waited, whether
+        # it is in the shared queue or was given to one of those threads by the load distribution
+        wait = self.run_queue.oldest_wait()
+        for thread in self.threads:
+            if int(thread.split("-")[1]) >= self.pin_threads:
+                wait = max(wait, self.threads[thread]["queue"].oldest_wait())
+        return wait
+
+    async def autoscale(self):
+        #
+        # Called from the utility loop, adds or removes at most one thread each time
+        #
+        autoscaling = self.autoscaling
+        if autoscaling is None:
+            return
+
+        now = await self.AD.sched.get_now()
+        unpinned = self.thread_count - self.pin_threads
+        qsize = self.unpinned_q_size()
+        wait = self.unpinned_oldest_wait()
+
+        if unpinned < autoscaling["max_threads"] and (
+            qsize > autoscaling["queue_threshold"] or wait > autoscaling["wait_threshold"]
+        ):
+            if wait > autoscaling["wait_threshold"]:
+                reason = "oldest callback waiting for {:.1f}s".format(wait)
+            else:
+                reason = "{} callbacks waiting".format(qsize)
+            thread_id = "thread-{}".format(self.thread_count)
+            await self.add_thread(silent=True)
+            self.threads_added += 1
+            await self.publish_scaling("added", thread_id, reason, now)
+            return
+
+        if unpinned <= autoscaling["min_threads"] or qsize > 0:
+            return
+
+        # Removing threads doesn't follow too closely on the last change
+        if self.last_scaled is not None and (now - self.last_scaled).total_seconds() < autoscaling["cooldown"]:
+            return
+
+        # Only the last thread is removed, so that the thread ids stay contiguous
+        thread_id = "thread-{}".format(self.thread_count - 1)
+        # Callbacks run with __silent don't update thread_activity, so the thread can look idle while it runs
+        # one. That, or a callback it picks up from here on, still finishes, as remove_thread() queues the stop
+        # sentinel behind it
+        with self.stats_lock:
+            activity = self.thread_activity.get(thread_id)
+        if activity is not None:
+            if activity["callback"] != "idle":
+                return
+            idle = (now - activity["time_called"]).total_seconds()
+            if idle < autoscaling["cooldown"]:
+                return
+            reason = "idle for {}s".format(int(idle))
+        else:
+            reason = "never used"
+
+        if self.get_q(thread_id).qsize() > 0 or await self.get_pinned_apps(thread_id):
+            return
+
+        await self.remove_thread(thread_id)
+        self.threads_removed += 1
+        await self.publish_scaling("removed", thread_id, reason, now)
+
+    async def publish_scaling(self, action, thread_id, reason, now):
+        self.last_scaled = now
+        self.logger.info("Autoscaler %s %s: %s", action, thread_id, reason)
+        await self.set_state(
+            "_threading",
+            "admin",
+            "sensor.threads_autoscaler",
+            state=self.thread_count - self.pin_threads,
+            last_action=action,
+            last_thread=thread_id,
+            last_reason=reason,
+            last_action_time=utils.dt_to_str(now, self.AD.tz),
+            threads_added=self.threads_added,
+            threads_removed=self.threads_removed,
+        )
+
+    def update_thread_info(self, thread_id, callback, app, type, uuid, silent):
+        #
+        # Record the start (or, when callback is "idle", the end) of a callback.
+        # Safe to call from worker threads - nothing touches the event loop until flush_thread_info() runs.
+        #
         self.logger.debug("Update thread info: %s", thread_id)
         if silent is True:
             return
@@ -381,86 +793,133 @@ class Threading:
 
         appentity = "{}.{}".format(appinfo["type"], app)
 
-        now = await self.AD.sched.get_now()
-        if callback == "idle":
-            start = utils.str_to_dt(
-                await self.get_state(
+        now = self.AD.sched.get_now_sync().replace(microsecond=0)
+        previous = None
+        with self.stats_lock:
+            if callback == "idle":
+                previous = self.thread_activity.get(thread_id)
+                self.threads_current_busy -= 1
+                self.pending_app_callbacks[appentity] = self.pending_app_callbacks.get(appentity, 0) + 1
+                entity = "{}_callback.{}".format(type, uuid)
+                self.pending_executed[entity] = self.pending_executed.get(entity, 0) + 1
+                self.callbacks_total_executed += 1
+                self.current_callbacks_executed += 1
+            else:
+                self.threads_current_busy += 1
+                self.current_callbacks_fired += 1
+
+            if self.threads_current_busy > self.threads_max_busy:
+                self.threads_max_busy = self.threads_current_busy
+                self.threads_max_busy_time = now
+                self.threads_last_action_time = now
+
+            self.thread_activity[thread_id] = {"callback": callback, "time_called": now}
+            self.dirty_threads.add(thread_id)
+            self.app_activity[appentity] = (app, callback)
+            self.stats_dirty = True
+
+        if (
+            previous is not None
+            and self.AD.sched.realtime is True
+            and (now - previous["time_called"]).total_seconds() >= self.AD.thread_duration_warning_threshold
+        ):
+            self.logger.warning(
+                "Thread %s: callback %s has now completed",
+                "thread.{}".format(thread_id),
+                previous["callback"],
+            )
+
+    def get_thread_activity(self, thread_id):
+        #
+        # Returns (callback, time_called) for the thread's current callback, as seen by the workers
+        #
+        with self.stats_lock:
+            activity = self.thread_activity.get(thread_id)
+        if activity is None:
+            return "idle", datetime.datetime(1970, 1, 1, 0, 0, 0, 0)
+        return activity["callback"], activity["time_called"]
+
+    def update_callback_fired(self, type, uuid):
+        entity = "{}_callback.{}".format(type, uuid)
+        with self.stats_lock:
+            self.pending_fired[entity] = self.pending_fired.get(entity, 0) + 1
+            self.callbacks_total_fired += 1
+            self.stats_dirty = True
+
+    async def flush_thread_info(self):
+        #
+        # Publish the statistics accumulated since the last flush to the admin namespace
+        #
+        with self.stats_lock:
+            if self.stats_dirty is False:
+                return
+
+            thread_activity = {thread_id: self.thread_activity[thread_id] for thread_id in self.dirty_threads}
+            app_activity = self.app_activity
+            pending_fired = self.pending_fired
+            pending_executed = self.pending_executed
+            pending_app_callbacks = self.pending_app_callbacks
+            self.dirty_threads = set()
+            self.app_activity = {}
+            self.pending_fired = {}
+            self.pending_executed = {}
+            self.pending_app_callbacks = {}
+
+            totals = {
+                "sensor.callbacks_total_fired": self.callbacks_total_fired,
+                "sensor.callbacks_total_executed": self.callbacks_total_executed,
+                "sensor.threads_current_busy": self.threads_current_busy,
+                "sensor.threads_max_busy": self.threads_max_busy,
+                "sensor.threads_max_busy_time": utils.dt_to_str(self.threads_max_busy_time, self.AD.tz),
+                "sensor.threads_last_action_time": utils.dt_to_str(self.threads_last_action_time, self.AD.tz),
+            }
+            self.stats_dirty = False
+
+        for entity, value in totals.items():
+            if await self.get_state("_threading", "admin", entity) != value:
+                await self.set_state("_threading", "admin", entity, state=value)
+
+        for entity, count in pending_fired.items():
+            await self.add_to_attr("_threading", "admin", entity, "fired", count)
+
+        for entity, count in pending_executed.items():
+            await self.add_to_attr("_threading", "admin", entity, "executed", count)
+
+        for appentity, count in pending_app_callbacks.items():
+            await self.add_to_attr("_threading", "admin", appentity, "totalcallbacks", count)
+            await self.add_to_attr("_threading", "admin", appentity, "instancecallbacks", count)
+
+        for thread_id, activity in thread_activity.items():
+            time_called = utils.dt_to_str(activity["time_called"], self.AD.tz)
+            if thread_id == "async":
+                await self.set_state(
                     "_threading",
                     "admin",
                     "thread.{}".format(thread_id),
-                    attribute="time_called",
+                    q=0,
+                    state=activity["callback"],
+                    time_called=time_called,
+                    is_alive=True,
+                    pinned_apps=[],
                 )
-            )
-            if (
-                self.AD.sched.realtime is True
-                and (now - start).total_seconds() >= self.AD.thread_duration_warning_threshold
-            ):
-                self.logger.warning(
-                    "Thread %s: callback %s has now completed",
+            elif thread_id in self.threads:
+                await self.set_state(
+                    "_threading",
+                    "admin",
                     "thread.{}".format(thread_id),
-                    await self.get_state("_threading", "admin", "thread.{}".format(thread_id)),
+                    q=self.threads[thread_id]["queue"].qsize(),
+                    state=activity["callback"],
+                    time_called=time_called,
+                    is_alive=self.threads[thread_id]["thread"].is_alive(),
+                    pinned_apps=await self.get_pinned_apps(thread_id),
                 )
-            await self.add_to_state("_threading", "admin", "sensor.threads_current_busy", -1)
 
-            await self.add_to_attr("_threading", "admin", appentity, "totalcallbacks", 1)
-            await self.add_to_attr("_threading", "admin", appentity, "instancecallbacks", 1)
-
-            await self.add_to_attr(
-                "_threading",
-                "admin",
-                "{}_callback.{}".format(type, uuid),
-                "executed",
-                1,
-            )
-            await self.add_to_state("_threading", "admin", "sensor.callbacks_total_executed", 1)
-            self.current_callbacks_executed += 1
-        else:
-            await self.add_to_state("_threading", "admin", "sensor.threads_current_busy", 1)
-            self.current_callbacks_fired += 1
-
-        current_busy = await self.get_state("_threading", "admin", "sensor.threads_current_busy")
-        max_busy = await self.get_state("_threading", "admin", "sensor.threads_max_busy")
-        if current_busy > max_busy:
-            await self.set_state("_threading", "admin", "sensor.threads_max_busy", state=current_busy)
-            await self.set_state(
-                "_threading",
-                "admin",
-                "sensor.threads_max_busy_time",
-                state=utils.dt_to_str((await self.AD.sched.get_now()).replace(microsecond=0), self.AD.tz),
-            )
-
-            await self.set_state(
-                "_threading",
-                "admin",
-                "sensor.threads_last_action_time",
-                state=utils.dt_to_str((await self.AD.sched.get_now()).replace(microsecond=0), self.AD.tz),
-            )
-
-        # Update thread info
-
-        if thread_id == "async":
-            await self.set_state(
-                "_threading",
-                "admin",
-                "thread.{}".format(thread_id),
-                q=0,
-                state=callback,
-                time_called=utils.dt_to_str(now.replace(microsecond=0), self.AD.tz),
-                is_alive=True,
-                pinned_apps=[],
-            )
-        else:
-            await self.set_state(
-                "_threading",
-                "admin",
-                "thread.{}".format(thread_id),
-                q=self.threads[thread_id]["queue"].qsize(),
-                state=callback,
-                time_called=utils.dt_to_str(now.replace(microsecond=0), self.AD.tz),
-                is_alive=self.threads[thread_id]["thread"].is_alive(),
-                pinned_apps=await self.get_pinned_apps(thread_id),
-            )
-        await self.set_state("_threading", "admin", appentity, state=callback)
+        for appentity, (app, callback) in app_activity.items():
+            appinfo = self.AD.app_management.get_app_info(app)
+            if appinfo is None or (appinfo["type"] == "app" and appinfo["running"] is not True):
+                # terminated since the callback ran, so leave its state alone
+                continue
+            await self.set_state("_threading", "admin", appentity, state=callback)
 
     #
     # Pinning
@@ -485,7 +944,7 @@ class Threading:
                 {"q": 0, "is_alive": True, "time_called": utils.dt_to_str(datetime.datetime(1970, 1, 1, 0, 0, 0, 0))},
             )
             self.threads[name] = {}
-            self.threads[name]["queue"] = Queue(maxsize=0)
+            self.threads[name]["queue"] = self.run_queue.get_q(name)
             t.start()
             self.thread_count += 1
             if pinthread is True:
@@ -498,9 +957,25 @@ class Threading:
                 state="idle",
                 is_alive=True,
             )
+            # Restarting a dead thread, it takes over the thread's queue and releases the lane it died in
+            t.start()
 
         self.threads[name]["thread"] = t
 
+    async def remove_thread(self, thread_id):
+        # Only the last thread can be removed, as callbacks are given to threads by number
+        thread = self.threads.pop(thread_id)
+        self.thread_count -= 1
+        if self.next_thread >= self.thread_count:
+            self.next_thread = self.pin_threads
+
+        with self.stats_lock:
+            self.thread_activity.pop(thread_id, None)
+            self.dirty_threads.discard(thread_id)
+
+        thread["queue"].stop()
+        await self.AD.state.remove_entity("admin", "thread.{}".format(thread_id))
+
     async def calculate_pin_threads(self):
 
         if self.pin_threads == 0:
@@ -539,12 +1014,54 @@ class Threading:
     def app_should_be_pinned(self, name):
         # Check apps.yaml first - allow override
         app = self.AD.app_management.app_config[name]
+
+        # Lanes already keep the app's callbacks in order
+        if self.app_should_be_lane(name):
+            return False
+
         if "pin_app" in app:
             return app["pin_app"]
 
         # if not, go with the global default
         return self.pin_apps
 
+    def app_should_be_lane(self, name):
+        app = self.AD.app_management.app_config[name]
+        if "lane_app" in app:
+            return app["lane_app"] is True
+
+        return self.lane_apps is True
+
+    def app_executor(self, name):
+        executor = self.AD.app_management.app_config[name].get("executor", "thread")
+        if executor not in ("thread", "process"):
+            self.logger.warning("Invalid executor '%s' for app %s, using 'thread'", executor, name)
+            executor = "thread"
+        return executor
+
+    def app_priority(self, name):
+        # Not "priority", which sets the order apps are loaded in
+        priority = self.AD.app_management.app_config[name].get("callback_priority", 0)
+        if not self.is_priority(priority):
+            self.logger.warning("Invalid callback_priority '%s' for app %s, using 0", priority, name)
+            priority = 0
+        return priority
+
+    @staticmethod
+    def is_priority(priority):
+        return isinstance(priority, (int, float)) and not isinstance(priority, bool)
+
+    def validate_priority(self, name, kwargs):
+        # Called when a callback is registered, an invalid priority is dropped for the app's default
+        if "priority" in kwargs and not self.is_priority(kwargs["priority"]):
+            self.logger.warning(
+                "Invalid value for priority (%s) in app: %s - using the app's default", kwargs["priority"], name
+            )
+            del kwargs["priority"]
+
+    def app_is_lane(self, name):
+        return self.AD.app_management.objects.get(name, {}).get("lane_app", False)
+
     async def get_app_pin(self, name):
         return self.AD.app_management.objects[name]["pin_app"]
 
@@ -584,49 +1101,74 @@ class Threading:
     # Constraints
     #
 
-    async def check_constraint(self, key, value, app):
-        """Used to check Constraint"""
-
-        unconstrained = True
-        if key in app.list_constraints():
-            method = getattr(app, key)
-            unconstrained = await utils.run_async_sync_func(self, method, value)
-
-        return unconstrained
-
-    async def check_time_constraint(self, args, name):
-        """Used to check time Constraint"""
-
-        unconstrained = True
-        if "constrain_start_time" in args or "constrain_end_time" in args:
-            if "constrain_start_time" not in args:
-                start_time = "00:00:00"
-            else:
-                start_time = args["constrain_start_time"]
-            if "constrain_end_time" not in args:
-                end_time = "23:59:59"
+    def compile_constraints(self, name, args):
+        """Compiles the constraints in a callback's kwargs, called when the callback is registered."""
+
+        app = self.AD.app_management.objects[name]["object"] if name in self.AD.app_management.objects else None
+        return Constraints(app, args, self.logger, name)
+
+    def get_callback_constraints(self, name, args):
+        constraints = args.get("constraints")
+        app = self.AD.app_management.objects[name]["object"]
+        if constraints is None or not constraints.is_current(app, args["kwargs"]):
+            constraints = Constraints(app, args["kwargs"], self.logger, name)
+        return constraints
+
+    def get_app_constraints(self, name):
+        config = self.AD.app_management.app_config.get(name)
+        if config is None:
+            # Plugins have no config
+            return None
+
+        app = self.AD.app_management.objects[name]["object"]
+        constraints = self.app_constraints.get(name)
+        if constraints is None or not constraints.is_current(app, config):
+            # The app has been (re)created, its config has been reloaded or it has registered constraints
+            constraints = Constraints(app, config, self.logger, name)
+            self.app_constraints[name] = constraints
+        return constraints
+
+    async def check_constraints(self, constraints, name):
+        """Returns ``True`` if the compiled constraints pass, apart from the state constraint."""
+
+        if constraints.days is not None or constraints.start_time is not None:
+            now = (await self.AD.sched.get_now()).astimezone(self.AD.tz)
+
+            if constraints.days is not None and now.weekday() not in constraints.days:
+                return False
+
+            if constraints.start_time is not None and not await self.check_time_window(constraints, now, name):
+                return False
+
+        for method, value in constraints.custom:
+            if not await utils.run_async_sync_func(self, method, value):
+                return False
+
+        return True
+
+    async def check_time_window(self, constraints, now, name):
+        today = now.date()
+        if constraints.window_date != today:
+            # Only the times are kept, sunrise and sunset based times change from day to day
+            start_time = (await self.AD.sched._parse_time(constraints.start_time, name))["datetime"]
+            end_time = (await self.AD.sched._parse_time(constraints.end_time, name))["datetime"]
+            constraints.window = (
+                start_time.time().replace(microsecond=0),
+                end_time.time().replace(microsecond=999999),
+            )
+            constraints.window_date = today
+
+        # The offset is worked out for each date, as it changes on the days the clocks go forward or back
+        start_time, end_time = constraints.window
+        start_date = self.AD.tz.localize(datetime.datetime.combine(today, start_time))
+        end_date = self.AD.tz.localize(datetime.datetime.combine(today, end_time))
+        if end_time < start_time:
+            # Spans midnight
+            if now <= end_date:
+                start_date = self.AD.tz.localize(datetime.datetime.combine(today - timedelta(days=1), start_time))
             else:
-                end_time = args["constrain_end_time"]
-            if await self.AD.sched.now_is_between(start_time, end_time, name) is False:
-                unconstrained = False
-
-        return unconstrained
-
-    async def check_days_constraint(self, args, name):
-        """Used to check days Constraint"""
-
-        unconstrained = True
-        if "constrain_days" in args:
-            days = args["constrain_days"]
-            now = await self.AD.sched.get_now()
-            daylist = []
-            for day in days.split(","):
-                daylist.append(await utils.run_in_executor(self, utils.day_of_week, day))
-
-            if now.weekday() not in daylist:
-                unconstrained = False
-
-        return unconstrained
+                end_date = self.AD.tz.localize(datetime.datetime.combine(today + timedelta(days=1), end_time))
+        return start_date <= now <= end_date
 
     async def check_state_constraint(self, args, new_state, name):
         """Used to check state Constraint"""
@@ -655,6 +1197,8 @@ class Threading:
         uuid_,
         pin_app,
         pin_thread,
+        rate_limit=None,
+        constraints=None,
     ):
         executed = False
         # kwargs["handle"] = uuid_
@@ -662,7 +1206,7 @@ class Threading:
         #
         #
         if attribute == "all":
-            executed = await self.dispatch_worker(
+            executed = await self.dispatch_rate_limited(
                 name,
                 {
                     "id": uuid_,
@@ -677,7 +1221,9 @@ class Threading:
                     "pin_app": pin_app,
                     "pin_thread": pin_thread,
                     "kwargs": kwargs,
+                    "constraints": constraints,
                 },
+                rate_limit,
             )
         else:
             #
@@ -767,7 +1313,7 @@ class Threading:
                         #
                         # Not a delay so make the callback immediately
                         #
-                        executed = await self.dispatch_worker(
+                        executed = await self.dispatch_rate_limited(
                             name,
                             {
                                 "id": uuid_,
@@ -782,82 +1328,116 @@ class Threading:
                                 "pin_app": pin_app,
                                 "pin_thread": pin_thread,
                                 "kwargs": kwargs,
+                                "constraints": constraints,
                             },
+                            rate_limit,
                         )
 
         return executed
 
+    async def dispatch_rate_limited(self, name, args, rate_limit=None):
+        """Dispatches a state or event callback, subject to its ``throttle``, ``debounce`` and ``max_rate``.
+
+        The constraints are checked first, so that only calls that would run count against the limits. Calls
+        that are dropped or held back aren't copied or queued to a thread.
+
+        Returns:
+            ``True`` if the callback was dispatched straight away, ``False`` otherwise.
+
+        """
+
+        if rate_limit is None:
+            return await self.dispatch_worker(name, args)
+
+        if not await self.check_dispatch_constraints(name, args):
+            return False
+
+        if rate_limit.debounce is not None:
+            rate_limit.defer(self.AD.loop, args, lambda latest: self.dispatch_debounced(name, latest, rate_limit))
+            return False
+
+        if not rate_limit.allow(self.AD.loop.time()):
+            return False
+
+        return self.queue_callback(name, args)
+
+    async def dispatch_debounced(self, name, args, rate_limit):
+        # Checked again, as the constraints may no longer hold once the debounce window has passed
+        if not await self.check_dispatch_constraints(name, args) or not rate_limit.allow(self.AD.loop.time()):
+            return
+
+        executed = self.queue_callback(name, args)
+
+        # The dispatch is no longer under the caller's control, so remove oneshot callbacks here
+        if executed is True and args["kwargs"].get("oneshot", False) is True:
+            if args["type"] == "state":
+                await self.AD.state.cancel_state_callback(args["id"], name)
+            else:
+                timeout = args["kwargs"].get("__timeout")
+                if timeout is not None and self.AD.sched.timer_running(name, timeout):
+                    await self.AD.sched.cancel_timer(name, timeout)
+                await self.AD.events.cancel_event_callback(name, args["id"])
+
     async def dispatch_worker(self, name, args):
+        if not await self.check_dispatch_constraints(name, args):
+            return False
+
+        return self.queue_callback(name, args)
+
+    async def check_dispatch_constraints(self, name, args):
         unconstrained = True
         #
         # Argument Constraints
         # (plugins have no args so skip if necessary)
         #
-        if name in self.AD.app_management.app_config:
-            for arg in self.AD.app_management.app_config[name].keys():
-                constrained = await self.check_constraint(
-                    arg,
-                    self.AD.app_management.app_config[name][arg],
-                    self.AD.app_management.objects[name]["object"],
-                )
-                if not constrained:
-                    unconstrained = False
-            if not await self.check_time_constraint(self.AD.app_management.app_config[name], name):
-                unconstrained = False
-            elif not await self.check_days_constraint(self.AD.app_management.app_config[name], name):
-                unconstrained = False
+        constraints = self.get_app_constraints(name)
+        if constraints is not None and not constraints.empty:
+            unconstrained = await self.check_constraints(constraints, name)
 
         #
-        # Callback level constraints
+        # Callback level constraints, compiled when the callback was registered
         #
-        myargs = utils.deepcopy(args)
-        if "kwargs" in myargs:
-            for arg in myargs["kwargs"].keys():
-                constrained = await self.check_constraint(
-                    arg,
-                    myargs["kwargs"][arg],
-                    self.AD.app_management.objects[name]["object"],
-                )
-                if not constrained:
-                    unconstrained = False
-            if not await self.check_time_constraint(myargs["kwargs"], name):
-                unconstrained = False
-            elif not await self.check_days_constraint(myargs["kwargs"], name):
-                unconstrained = False
+        if unconstrained and "kwargs" in args:
+            constraints = self.get_callback_constraints(name, args)
+            if not constraints.empty:
+                unconstrained = await self.check_constraints(constraints, name)
 
-            #
-            # Lets determine the state constraint
-            #
-            if myargs["type"] == "state":
-                state_unconstrained = await self.check_state_constraint(myargs["kwargs"], myargs["new_state"], name)
-                unconstrained = all((unconstrained, state_unconstrained))
+                #
+                # Lets determine the state constraint
+                #
+                if unconstrained and args["type"] == "state":
+                    unconstrained = await self.check_state_constraint(args["kwargs"], args["new_state"], name)
 
-        if unconstrained:
-            #
-            # It's going to happen
-            #
-            if "__silent" in args["kwargs"] and args["kwargs"]["__silent"] is True:
-                pass
-            else:
-                await self.add_to_state("_threading", "admin", "sensor.callbacks_total_fired", 1)
-                await self.add_to_attr(
-                    "_threading",
-                    "admin",
-                    "{}_callback.{}".format(myargs["type"], myargs["id"]),
-                    "fired",
-                    1,
-                )
-            #
-            # And Q
-            #
-            if asyncio.iscoroutinefunction(myargs["function"]):
-                f = asyncio.ensure_future(self.async_worker(myargs))
-                self.AD.futures.add_future(name, f)
-            else:
-                self.select_q(myargs)
-            return True
+        return unconstrained
+
+    def queue_callback(self, name, args):
+        #
+        # It's going to happen
+        #
+        if "__silent" in args["kwargs"] and args["kwargs"]["__silent"] is True:
+            pass
         else:
-            return False
+            self.update_callback_fired(args["type"], args["id"])
+        #
+        # The state and event payloads are shared with AppDaemon's state and the other callbacks. They are
+        # frozen when they are stored or processed, so freeze() just hands them on, and only copies what was
+        # never frozen, such as records loaded from a persistent namespace. The kwargs are copied, as the
+        # worker adds to them and they belong to the callback registration.
+        #
+        myargs = dict(args)
+        myargs["kwargs"] = dict(args["kwargs"])
+        for key in ("new_state", "old_state", "data"):
+            if key in myargs:
+                myargs[key] = utils.freeze(myargs[key])
+        #
+        # And Q
+        #
+        if asyncio.iscoroutinefunction(myargs["function"]):
+            f = asyncio.ensure_future(self.async_worker(myargs))
+            self.AD.futures.add_future(name, f)
+        else:
+            self.select_q(myargs)
+        return True
 
     # noinspection PyBroadException
     async def async_worker(self, args):  # noqa: C901
@@ -879,7 +1459,7 @@ class Threading:
             try:
                 if _type == "scheduler":
                     try:
-                        await self.update_thread_info("async", callback, name, _type, _id, silent)
+                        self.update_thread_info("async", callback, name, _type, _id, silent)
                         await funcref(self.AD.sched.sanitize_timer_kwargs(app, args["kwargs"]))
                     except TypeError:
                         self.report_callback_sig(name, "scheduler", funcref, args)
@@ -890,7 +1470,7 @@ class Threading:
                         attr = args["attribute"]
                         old_state = args["old_state"]
                         new_state = args["new_state"]
-                        await self.update_thread_info("async", callback, name, _type, _id, silent)
+                        self.update_thread_info("async", callback, name, _type, _id, silent)
                         await funcref(
                             entity,
                             attr,
@@ -904,7 +1484,7 @@ class Threading:
                 elif _type == "log":
                     data = args["data"]
                     try:
-                        await self.update_thread_info("async", callback, name, _type, _id, silent)
+                        self.update_thread_info("async", callback, name, _type, _id, silent)
                         await funcref(
                             data["app_name"],
                             data["ts"],
@@ -919,7 +1499,7 @@ class Threading:
                 elif _type == "event":
                     data = args["data"]
                     try:
-                        await self.update_thread_info("async", callback, name, _type, _id, silent)
+                        self.update_thread_info("async", callback, name, _type, _id, silent)
                         await funcref(args["event"], data, self.AD.events.sanitize_event_kwargs(app, args["kwargs"]))
                     except TypeError:
                         self.report_callback_sig(name, "event", funcref, args)
@@ -938,7 +1518,7 @@ class Threading:
                     )
             finally:
                 pass
-                await self.update_thread_info("async", "idle", name, _type, _id, silent)
+                self.update_thread_info("async", "idle", name, _type, _id, silent)
 
         else:
             if not self.AD.stopping:
@@ -950,6 +1530,9 @@ class Threading:
         q = self.get_q(thread_id)
         while True:
             args = q.get()
+            if args is None:
+                # Removed by the autoscaler
+                return
             _type = args["type"]
             funcref = args["function"]
             _id = args["id"]
@@ -962,15 +1545,13 @@ class Threading:
             if "__silent" in args["kwargs"]:
                 silent = args["kwargs"]["__silent"]
 
-            app = utils.run_coroutine_threadsafe(self, self.AD.app_management.get_app_instance(name, objectid))
+            # Resolve the app without a round trip to the event loop so a busy loop can't stall the workers
+            app = self.AD.app_management.get_app_instance_nowait(name, objectid)
             if app is not None:
                 try:
                     if _type == "scheduler":
                         try:
-                            utils.run_coroutine_threadsafe(
-                                self,
-                                self.update_thread_info(thread_id, callback, name, _type, _id, silent),
-                            )
+                            self.update_thread_info(thread_id, callback, name, _type, _id, silent)
                             funcref(self.AD.sched.sanitize_timer_kwargs(app, args["kwargs"]))
                         except TypeError:
                             self.report_callback_sig(name, "scheduler", funcref, args)
@@ -981,10 +1562,7 @@ class Threading:
                             attr = args["attribute"]
                             old_state = args["old_state"]
                             new_state = args["new_state"]
-                            utils.run_coroutine_threadsafe(
-                                self,
-                                self.update_thread_info(thread_id, callback, name, _type, _id, silent),
-                            )
+                            self.update_thread_info(thread_id, callback, name, _type, _id, silent)
                             funcref(
                                 entity,
                                 attr,
@@ -998,10 +1576,7 @@ class Threading:
                     if _type == "log":
                         data = args["data"]
                         try:
-                            utils.run_coroutine_threadsafe(
-                                self,
-                                self.update_thread_info(thread_id, callback, name, _type, _id, silent),
-                            )
+                            self.update_thread_info(thread_id, callback, name, _type, _id, silent)
                             funcref(
                                 data["app_name"],
                                 data["ts"],
@@ -1016,10 +1591,7 @@ class Threading:
                     elif _type == "event":
                         data = args["data"]
                         try:
-                            utils.run_coroutine_threadsafe(
-                                self,
-                                self.update_thread_info(thread_id, callback, name, _type, _id, silent),
-                            )
+                            self.update_thread_info(thread_id, callback, name, _type, _id, silent)
                             funcref(args["event"], data, self.AD.events.sanitize_event_kwargs(app, args["kwargs"]))
                         except TypeError:
                             self.report_callback_sig(name, "event", funcref, args)
@@ -1037,10 +1609,7 @@ class Threading:
                             self.AD.logging.get_filename("error_log"),
                         )
                 finally:
-                    utils.run_coroutine_threadsafe(
-                        self,
-                        self.update_thread_info(thread_id, "idle", name, _type, _id, silent),
-                    )
+                    self.update_thread_info(thread_id, "idle", name, _type, _id, silent)
 
             else:
                 if not self.AD.stopping:
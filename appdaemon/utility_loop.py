@@ -158,6 +158,11 @@ class Utility:
 
                     await self.AD.plugins.update_plugin_state()
 
+                    # Publish thread statistics if there is no admin loop to do it for us
+
+                    if self.AD.apps is True and self.AD.admin_loop is None:
+                        await self.AD.threading.flush_thread_info()
+
                     # Check for thread starvation
 
                     (
@@ -165,6 +170,14 @@ class Utility:
                         warning_iterations,
                     ) = await self.AD.threading.check_q_size(warning_step, warning_iterations)
 
+                    # Add or remove threads if autoscaling
+
+                    await self.AD.threading.autoscale()
+
+                    # Publish event queue metrics
+
+                    await self.AD.events.update_event_queue_sensors()
+
                     # Check for any overdue threads
 
                     await self.AD.threading.check_overdue_and_dead_threads()
@@ -173,6 +186,10 @@ class Utility:
 
                     self.AD.state.save_hybrid_namespaces()
 
+                    # Write out any batched namespaces that are due
+
+                    await self.AD.state.save_batched_namespaces()
+
                     # Run utility for each plugin
 
                     self.AD.plugins.run_plugin_utility()
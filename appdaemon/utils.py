@@ -8,6 +8,8 @@ import cProfile
 import io
 import pstats
 import shelve
+import sqlite3
+import pickle
 import threading
 import datetime
 import dateutil.parser
@@ -17,7 +19,7 @@ import json
 import inspect
 from functools import wraps
 from appdaemon.version import __version__  # noqa: F401
-from collections.abc import Iterable
+from collections.abc import Iterable, MutableMapping
 import concurrent.futures
 
 if platform.system() != "Windows":
@@ -141,6 +143,192 @@ class PersistentDict(shelve.DbfilenameShelf):
                     self.sync()
 
 
+class BatchedPersistentDict(MutableMapping):
+    """
+    Dict-like object that keeps its contents in memory and writes changed keys to a Shelf in batches.
+
+    Only the keys set or deleted since the last flush are written, so values must be replaced rather than mutated
+    in place. ``flush()`` is blocking and is meant to be run off the event loop.
+
+    With ``safe``, each change is written before the call that made it returns, as with a safe ``PersistentDict``.
+
+    Other storage engines override ``load()``, ``write_batch()``, ``fsync_files()`` and ``close()``.
+    """
+
+    def __init__(self, filename, flush_interval=1, flush_size=100, fsync=False, on_flush_size=None, safe=False):
+        self.filename = filename
+        self.safe = safe
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.fsync = fsync
+        # Called (from whichever thread made the change) when flush_size keys are waiting to be written
+        self.on_flush_size = on_flush_size
+        self.rlock = threading.RLock()
+        # Held for the whole of a flush so that batches reach the disk in order
+        self.flush_lock = threading.Lock()
+        self.data = self.load()
+        self.dirty = set()
+        self.last_flush = time.monotonic()
+        # Set by close(), after which nothing more is written
+        self.closed = False
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __copy__(self):
+        return dict(self.data)
+
+    def __deepcopy__(self, memo):
+        return copy.deepcopy(dict(self.data), memo=memo)
+
+    def __delitem__(self, key):
+        with self.rlock:
+            del self.data[key]
+            self.mark_dirty(key)
+        if self.safe:
+            self.flush()
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __iter__(self):
+        with self.rlock:
+            return iter(list(self.data))
+
+    def __len__(self):
+        return len(self.data)
+
+    def __repr__(self):
+        return "%s(%r)" % (type(self).__name__, self.data)
+
+    def __setitem__(self, key, val):
+        with self.rlock:
+            self.data[key] = val
+            self.mark_dirty(key)
+        if self.safe:
+            self.flush()
+
+    def update(self, *args, **kwargs):
+        with self.rlock:
+            for key, value in dict(*args, **kwargs).items():
+                self.data[key] = value
+                self.mark_dirty(key)
+        if self.safe:
+            self.flush()
+
+    def mark_dirty(self, key):
+        self.dirty.add(key)
+        if len(self.dirty) == self.flush_size and self.on_flush_size is not None:
+            self.on_flush_size()
+
+    def flush_due(self):
+        with self.rlock:
+            if not self.dirty:
+                return False
+            return len(self.dirty) >= self.flush_size or time.monotonic() - self.last_flush >= self.flush_interval
+
+    def flush(self):
+        with self.flush_lock:
+            if self.closed:
+                return 0
+
+            with self.rlock:
+                dirty = self.dirty
+                self.dirty = set()
+                self.last_flush = time.monotonic()
+                writes = {key: self.data[key] for key in dirty if key in self.data}
+                deletes = [key for key in dirty if key not in self.data]
+
+            if not dirty:
+                return 0
+
+            try:
+                self.write_batch(writes, deletes)
+                if self.fsync:
+                    self.fsync_files()
+            except Exception:
+                # Keep the keys that didn't make it to disk for the next attempt
+                with self.rlock:
+                    self.dirty.update(dirty)
+                raise
+
+            return len(dirty)
+
+    def load(self):
+        self.shelf = shelve.open(self.filename, writeback=False)
+        return dict(self.shelf)
+
+    def write_batch(self, writes, deletes):
+        for key, value in writes.items():
+            self.shelf[key] = value
+        for key in deletes:
+            if key in self.shelf:
+                del self.shelf[key]
+        self.shelf.sync()
+
+    def fsync_files(self):
+        # The dbm backends name their files differently, so sync whichever of them exist
+        for path in (self.filename, self.filename + ".db", self.filename + ".dat", self.filename + ".dir"):
+            if os.path.isfile(path):
+                fd = os.open(path, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+
+    def sync(self):
+        self.flush()
+
+    def close(self):
+        with self.flush_lock:
+            if not self.closed:
+                self.closed = True
+                self.shelf.close()
+
+
+class SQLitePersistentDict(BatchedPersistentDict):
+    """
+    Batched persistent dict stored in a SQLite database in WAL mode.
+
+    Each entity is a row, so a batch is a single transaction of per key replaces and the whole namespace is loaded
+    with one query at startup. Values are pickled with the highest protocol, so they round trip exactly as with shelve.
+    """
+
+    def load(self):
+        # The connection is only ever used under flush_lock, from whichever executor thread is flushing
+        self.db = sqlite3.connect(self.filename, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous={}".format("FULL" if self.fsync else "NORMAL"))
+        self.db.execute("CREATE TABLE IF NOT EXISTS entities (key TEXT PRIMARY KEY, value BLOB NOT NULL) WITHOUT ROWID")
+        return {key: pickle.loads(value) for key, value in self.db.execute("SELECT key, value FROM entities")}
+
+    def write_batch(self, writes, deletes):
+        # Pickle before starting the transaction to keep it short
+        rows = [(key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL)) for key, value in writes.items()]
+        self.db.execute("BEGIN")
+        try:
+            self.db.executemany(
+                # Rather than an upsert, which needs SQLite 3.24
+                "INSERT OR REPLACE INTO entities (key, value) VALUES (?, ?)",
+                rows,
+            )
+            self.db.executemany("DELETE FROM entities WHERE key = ?", [(key,) for key in deletes])
+            self.db.execute("COMMIT")
+        except Exception:
+            self.db.execute("ROLLBACK")
+            raise
+
+    def fsync_files(self):
+        # synchronous=FULL already syncs the WAL on every commit
+        pass
+
+    def close(self):
+        with self.flush_lock:
+            if not self.closed:
+                self.closed = True
+                self.db.close()
+
+
 class AttrDict(dict):
     """Dictionary subclass whose entries can be accessed by attributes
     (as well as normally).
@@ -159,6 +347,80 @@ class AttrDict(dict):
             return AttrDict({key: AttrDict.from_nested_dict(data[key]) for key in data})
 
 
+def _read_only(self, *args, **kwargs):
+    raise TypeError(
+        "State records and event data are read only - use copy.deepcopy() to get a copy that can be changed"
+    )
+
+
+class FrozenDict(dict):
+    """Read only dict, used for state records and event data, so that they can be shared without copying them.
+
+    ``copy()``, ``copy.copy()`` and ``dict()`` return ordinary dicts of the same, still read only, values, while
+    ``copy.deepcopy()`` returns ordinary dicts and lists all the way down. Pickling also gives ordinary dicts.
+    """
+
+    __slots__ = ()
+
+    __setitem__ = __delitem__ = __ior__ = clear = pop = popitem = setdefault = update = _read_only
+
+    def copy(self):
+        return dict(self)
+
+    def __copy__(self):
+        return dict(self)
+
+    def __deepcopy__(self, memo):
+        return {copy.deepcopy(key, memo): copy.deepcopy(value, memo) for key, value in self.items()}
+
+    def __reduce__(self):
+        return dict, (dict(self),)
+
+
+class FrozenList(list):
+    """Read only list, used for the lists within state records and event data."""
+
+    __slots__ = ()
+
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _read_only
+    append = clear = extend = insert = pop = remove = reverse = sort = _read_only
+
+    def copy(self):
+        return list(self)
+
+    def __copy__(self):
+        return list(self)
+
+    def __deepcopy__(self, memo):
+        return [copy.deepcopy(value, memo) for value in self]
+
+    def __reduce__(self):
+        return list, (list(self),)
+
+
+def freeze(value):
+    """Returns a read only copy of ``value``, with ``FrozenDict`` and ``FrozenList`` in place of its dicts and lists.
+
+    Values that are already frozen are returned as they are.
+    """
+
+    if isinstance(value, dict):
+        if isinstance(value, FrozenDict):
+            return value
+        frozen = FrozenDict(value)
+        for key, item in value.items():
+            if isinstance(item, (dict, list)):
+                dict.__setitem__(frozen, key, freeze(item))
+        return frozen
+
+    if isinstance(value, list):
+        if isinstance(value, FrozenList):
+            return value
+        return FrozenList([freeze(item) for item in value])
+
+    return value
+
+
 class StateAttrs(dict):
     def __init__(self, dict):
         device_dict = {}